@@ -1,7 +1,32 @@
+import argparse
+import array
+import asyncio
+import collections
+import csv
 import chess
 import chess.engine
 import chess.pgn
+import chess.polyglot
+import chess.syzygy
+import io
+import itertools
+import json
 import math
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # optional: per-ply statistics are then computed one ply at a time
+    np = None
 
 # ---------------- CONFIG ----------------
 STOCKFISH_PATH = "/usr/local/bin/stockfish-bin"  # WSL path
@@ -9,12 +34,76 @@ PGN_INPUT = "input.pgn"
 PGN_OUTPUT = "annotated_output.pgn"
 REPORT_OUTPUT = "analysis_report.txt"
 DEPTH = 25  # analysis depth
-TOP_MOVES = 5  # for finding best alternatives
+TOP_MOVES = 5  # best alternatives searched (multipv) for annotated moves only
+VARIATION_PLIES = 8  # length of the engine lines kept and written as side variations
+
+# Adaptive depth: search everything at SHALLOW_DEPTH, then re-search at DEPTH
+# only the positions whose eval loss is within ADAPTIVE_MARGIN of a threshold
+ADAPTIVE = False
+SHALLOW_DEPTH = 12
+ADAPTIVE_MARGIN = 0.2  # pawns (see the adaptive suite of annotator_bench.py)
+
+# Positions answered without the engine: finished games, forced moves, mates
+# carried forward and, with a Syzygy tablebase directory, small endgames
+SYZYGY_PATH = None  # e.g. "syzygy/" (chess.syzygy tables)
+SYZYGY_MAX_PIECES = 5
+SHORTCUT_SOURCES = {
+    'finished': "game over",
+    'forced': "single legal move",
+    'mate': "mate carried forward",
+    'tablebase': "tablebase",
+}
+
+# Budget mode: a total engine time or node budget per game (or per batch) instead
+# of a fixed depth. A probe pass at up to SHALLOW_DEPTH gets BUDGET_PROBE_SHARE of
+# it; the rest goes to the positions with the most volatile evals, up to DEPTH
+BUDGET_PROBE_SHARE = 0.25
+DECIDED_EVAL = 4.0  # pawns: positions this far ahead only get a small share
+BUDGET_MIN_TIME = 0.01  # seconds: smallest time limit of an engine call
+BUDGET_MIN_NODES = 10000  # smallest node limit of an engine call
+
+# Batch mode: one Stockfish process per worker
+WORKERS = 1  # number of worker processes (games analysed in parallel)
+ENGINE_THREADS = 1  # Stockfish "Threads" option per worker
+ENGINE_HASH = 256  # Stockfish "Hash" option per worker (MB)
+GAME_ENGINES = 1  # engines sharing the positions of one game (asyncio pool)
+VARIATIONS = False  # also annotate the side variations of the input (see analyse_sidelines)
+ORDER = "input"  # or "opening": games sharing an opening run one after another (see opening_order)
+ORDER_PLIES = 40  # opening prefix length used to order games
+
+# Persistent evaluation cache (sqlite), shared between runs and workers
+CACHE_PATH = "eval_cache.sqlite"
+CACHE_MAX_ENTRIES = 500000  # least recently used entries are evicted above this
+
+# Optional Polyglot opening book: book moves are not searched nor annotated
+BOOK_PATH = None  # e.g. "book.bin"
+
+# Watch mode: a daemon annotating every PGN file dropped into an inbox directory,
+# with its engines kept running between files
+WATCH_INTERVAL = 0.2  # seconds between polls of the inbox
+WATCH_OUTBOX = "outbox"  # annotated PGN, reports and evals of <inbox>/<name>.pgn go to <outbox>/<name>...
+
+# Distributed mode: a coordinator serves the games of a PGN file as jobs over TCP
+# ("host:port") or a Unix socket (a path); workers on any machine search them with
+# their own Stockfish and stream the analyses back
+HEARTBEAT_INTERVAL = 5.0  # seconds between heartbeats of a worker whose engine searches are finishing
+HEARTBEAT_TIMEOUT = 30.0  # a job with no finished search for this long is handed to another worker
+WORKER_POLL = 1.0  # seconds an idle worker waits before asking for a job again
+
+# Cross-game summary (--aggregate): game accuracy percentiles per player, event and
+# colour come from fixed-bin sketches, so memory does not grow with the number of games
+AGGREGATE_PERCENTILES = (10, 50, 90)
+SKETCH_RESOLUTION = 0.5  # accuracy points per bin; percentiles are off by half a bin at most
+
+# Raw per-ply evaluations are saved next to the annotated PGN (<output> + suffix),
+# so games can be re-annotated with other thresholds without the engine
+EVALS_SUFFIX = ".evals.jsonl"
 
 # Negative annotation thresholds (in pawns)
 THRESH_INACCURACY = 0.4
 THRESH_MISTAKE = 0.8
 THRESH_BLUNDER = 1.8
+SKIP_MOVES = 2  # the first moves of each side are never annotated
 
 # NAG mapping - ONLY negative annotations
 ANNOTATIONS = {
@@ -30,6 +119,112 @@ NAG_NAMES = {
     4: "Blunders (??)",
 }
 
+# ---------------- CACHE ----------------
+
+def position_key(board):
+    """Cache key for a position: Zobrist hash plus halfmove and repetition state."""
+    if board.is_repetition(3):
+        repetitions = 2
+    elif board.is_repetition(2):
+        repetitions = 1
+    else:
+        repetitions = 0
+    return f"{chess.polyglot.zobrist_hash(board):016x}:{board.halfmove_clock}:{repetitions}"
+
+def encode_analysis(analysis):
+    """JSON-serialisable copy of a position analysis (moves as UCI strings)."""
+    data = dict(analysis)
+    data['top_moves'] = [(move.uci(), score) for move, score in analysis['top_moves']]
+    if 'lines' in analysis:
+        data['lines'] = [[move.uci() for move in line] for line in analysis['lines']]
+    return data
+
+def decode_analysis(data):
+    """Inverse of encode_analysis."""
+    analysis = dict(data)
+    analysis['top_moves'] = [(chess.Move.from_uci(uci), score) for uci, score in data['top_moves']]
+    if 'lines' in data:
+        analysis['lines'] = [[chess.Move.from_uci(uci) for uci in line] for line in data['lines']]
+    return analysis
+
+class EvalCache:
+    """On-disk LRU cache of position analyses, keyed by position, depth and multipv.
+    
+    An entry searched at depth D with multipv M answers any request with
+    depth <= D and multipv <= M.
+    """
+    
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS evals ("
+            " key TEXT NOT NULL, multipv INTEGER NOT NULL, depth INTEGER NOT NULL,"
+            " result TEXT NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (key, multipv))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS evals_last_used ON evals (last_used)")
+        self.conn.commit()
+        self._puts = 0
+    
+    def get(self, board, depth, multipv):
+        """Return a cached analysis satisfying depth and multipv, or None."""
+        key = position_key(board)
+        row = self.conn.execute(
+            "SELECT multipv, result FROM evals WHERE key = ? AND multipv >= ? AND depth >= ?"
+            " ORDER BY depth DESC LIMIT 1",
+            (key, multipv, depth),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE evals SET last_used = ? WHERE key = ? AND multipv = ?",
+                          (time.time(), key, row[0]))
+        self.conn.commit()
+        analysis = decode_analysis(json.loads(row[1]))
+        analysis['top_moves'] = analysis['top_moves'][:multipv]
+        if 'lines' in analysis:
+            analysis['lines'] = analysis['lines'][:multipv]
+        analysis['source'] = 'cache'
+        analysis['calls'] = []  # no engine call this time
+        return analysis
+    
+    def put(self, board, depth, multipv, analysis):
+        """Store an analysis, unless a deeper one is already cached."""
+        data = encode_analysis(analysis)
+        self.conn.execute(
+            "INSERT INTO evals (key, multipv, depth, result, last_used) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (key, multipv) DO UPDATE SET depth = excluded.depth,"
+            " result = excluded.result, last_used = excluded.last_used"
+            " WHERE excluded.depth >= evals.depth",
+            (position_key(board), multipv, depth, json.dumps(data), time.time()),
+        )
+        self.conn.commit()
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            self.evict()
+    
+    def evict(self):
+        """Drop the least recently used entries above max_entries."""
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM evals").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM evals WHERE rowid IN"
+                " (SELECT rowid FROM evals ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self.conn.commit()
+    
+    def close(self):
+        self.evict()
+        self.conn.close()
+
 # ---------------- FUNCTIONS ----------------
 
 def centipawns_to_win_percent(centipawns):
@@ -44,181 +239,829 @@ def calculate_move_accuracy(win_percent_before, win_percent_after):
     accuracy = 103.1668 * math.exp(-0.04354 * win_percent_loss) - 3.1669
     return max(0, min(100, accuracy))  # Clamp between 0 and 100
 
-def evaluate_position(engine, board):
-    """Return evaluation in pawns from White's perspective."""
-    info = engine.analyse(board, chess.engine.Limit(depth=DEPTH))
-    score = info["score"].white()  # Always from White's perspective
-    
+def score_to_pawns(score):
+    """Convert an engine score to pawns, with mates clamped to +/-100."""
     if isinstance(score, chess.engine.Cp):
         return score.score() / 100.0
-    elif isinstance(score, chess.engine.Mate):
-        mate_value = score.mate()
-        return 100.0 if mate_value > 0 else -100.0
+    elif score.is_mate():  # Mate, and MateGiven (mate on the board, not a Mate instance) as a win
+        return 100.0 if score > chess.engine.Cp(0) else -100.0
     else:
         return None
 
-def get_top_moves(engine, board, n=TOP_MOVES):
-    """Return top n moves with their evaluations from current player's perspective."""
-    info = engine.analyse(board, chess.engine.Limit(depth=DEPTH), multipv=n)
-    top_moves = []
+# Engine searches finished by this process, so a distributed worker can tell a slow game from a hung engine
+searches_finished = 0
+
+def analyse_position(engine, board, n=TOP_MOVES, cache=None, depth=DEPTH, limit=None):
+    """Search a position once and return its evaluation and top moves.
+    
+    The best line of the multipv search gives the evaluation (in pawns from
+    White's perspective), the other lines give the alternatives (in pawns from
+    the current player's perspective). With a cache, a stored result at the
+    same or a greater depth is returned without searching.
+    
+    limit replaces the depth limit of the search (e.g. a time or node budget
+    capped at depth); the analysis then records the depth actually reached.
+    """
+    if cache is not None:
+        cached = cache.get(board, depth, n)
+        if cached is not None:
+            return cached
+    
+    global searches_finished
+    start = time.perf_counter()
+    info = engine.analyse(board, limit or chess.engine.Limit(depth=depth), multipv=n)
+    searches_finished += 1
+    analysis = analysis_from_info(board, info, depth, time.perf_counter() - start, limit is not None)
+    if cache is not None:
+        cache.put(board, analysis['depth'], n, analysis)
+    return analysis
+
+def analysis_from_info(board, info, depth, elapsed, limited=False):
+    """Build a position analysis from the info returned by an engine search.
     
+    depth is the depth searched to, or with limited the cap of a search that
+    may have stopped earlier (the depth reached is then recorded instead).
+    """
     entries = info if isinstance(info, list) else [info]
     
+    evaluation = None
+    if entries and "score" in entries[0]:
+        evaluation = score_to_pawns(entries[0]["score"].white())
+    
+    top_moves = []
+    lines = []
     for entry in entries:
         if "pv" in entry and entry["pv"]:
             move = entry["pv"][0]
-            score = entry["score"].pov(board.turn)  # From current player's perspective
-            
-            if isinstance(score, chess.engine.Cp):
-                eval_score = score.score() / 100.0
-            elif isinstance(score, chess.engine.Mate):
-                mate_value = score.mate()
-                eval_score = 100.0 if mate_value > 0 else -100.0
-            else:
+            eval_score = score_to_pawns(entry["score"].pov(board.turn))
+            if eval_score is None:
                 continue
-                
             top_moves.append((move, eval_score))
+            lines.append(entry["pv"][:VARIATION_PLIES])
     
-    return top_moves
+    # Instrumentation of this engine call, from the info of the best line
+    first = entries[0] if entries else {}
+    call = {
+        'depth': depth,
+        'depth_reached': first.get("depth", 0),
+        'seldepth': first.get("seldepth", 0),
+        'nodes': first.get("nodes", 0),
+        'nps': first.get("nps", 0),
+        'multipv': len(entries),
+        'time': elapsed,
+    }
+    if limited:
+        depth = min(depth, call['depth_reached'])
+    return {'eval': evaluation, 'top_moves': top_moves, 'lines': lines, 'depth': depth, 'source': 'engine',
+            'calls': [call]}
 
-def clean_game_annotations(game):
-    """Remove all existing comments and NAGs from the game."""
-    # Clean the root game node
-    game.comment = ""
+def search_positions(engine, boards, n=TOP_MOVES, cache=None, depth=DEPTH, on_result=None,
+                     budget=None, weights=None, required=True, skip=None):
+    """Analyse several positions, returned in order.
+    
+    An EnginePool searches them concurrently, a single engine one after another.
+    on_result(index, analysis) is called as soon as each position is done.
+    
+    With a SearchBudget every search gets a share of what is left of it, in
+    proportion to weights (default: equal), capped at depth. Unless required,
+    positions are left out (None) once the budget is spent.
+    
+    skip(index), when given, is asked just before each search and may return
+    an analysis to use instead (positions are taken in input order).
+    """
+    if budget is not None and weights is None:
+        weights = [1.0] * len(boards)
+    
+    if isinstance(engine, EnginePool):
+        limits = None
+        if budget is not None:
+            if not required and budget.remaining() <= 0:
+                return [None] * len(boards)
+            limits = [budget.limit(weight, sum(weights), depth) for weight in weights]
+        analyses = engine.analyse_many(boards, n, cache, depth, on_result, limits, skip)
+        if budget is not None:
+            for analysis in analyses:
+                budget.record(analysis)
+        return analyses
+    
+    analyses = []
+    pending_weight = sum(weights) if budget is not None else 0
+    for index, board in enumerate(boards):
+        skipped = skip(index) if skip is not None else None
+        if skipped is not None:
+            analyses.append(skipped)
+            if budget is not None:
+                pending_weight -= weights[index]
+            if on_result is not None:
+                on_result(index, skipped)
+            continue
+        limit = None
+        if budget is not None:
+            if not required and budget.remaining() <= 0:
+                analyses.append(None)
+                continue
+            # What earlier searches left unspent goes to the later ones
+            limit = budget.limit(weights[index], pending_weight, depth)
+            pending_weight -= weights[index]
+        analyses.append(analyse_position(engine, board, n, cache, depth, limit))
+        if budget is not None:
+            budget.record(analyses[-1])
+        if on_result is not None:
+            on_result(index, analyses[-1])
+    return analyses
+
+def evaluate_position(engine, board):
+    """Return evaluation in pawns from White's perspective."""
+    return analyse_position(engine, board, 1)['eval']  # Always from White's perspective
+
+def get_top_moves(engine, board, n=TOP_MOVES):
+    """Return top n moves with their evaluations from current player's perspective."""
+    return analyse_position(engine, board, n)['top_moves']
+
+def open_book(book_path):
+    """Open a Polyglot opening book, or return None when no book is configured."""
+    if book_path is None:
+        return None
+    return chess.polyglot.open_reader(book_path)
+
+def count_book_plies(game, book):
+    """Number of leading mainline moves found in the opening book."""
+    if book is None:
+        return 0
+    board = game.board()
+    plies = 0
+    for move in game.mainline_moves():
+        if not any(entry.move == move for entry in book.find_all(board)):
+            break
+        board.push(move)
+        plies += 1
+    return plies
+
+def book_analysis(board, cache=None):
+    """Analysis for a position whose mainline move is in the opening book.
+    
+    No engine call is made: the evaluation is taken from the cache when some
+    earlier run stored one (at any depth), otherwise it is left unknown.
+    """
+    stored = cache.get(board, 0, 1) if cache is not None else None
+    if stored is None:
+        return {'eval': None, 'top_moves': [], 'depth': 0, 'source': 'book', 'calls': []}
+    return {'eval': stored['eval'], 'top_moves': [], 'depth': stored['depth'], 'source': 'book', 'calls': []}
+
+def open_tablebase(syzygy_path):
+    """Open a Syzygy tablebase directory, or return None when none is configured."""
+    if syzygy_path is None:
+        return None
+    return chess.syzygy.open_tablebase(syzygy_path)
+
+def shortcut_analysis(board, tablebase=None):
+    """Analysis of a position that needs no search, or None.
+    
+    Finished games are scored by the rules; with a tablebase, positions with
+    at most SYZYGY_MAX_PIECES pieces are scored by probing it (wins as mates,
+    50-move-rule wins as draws).
+    """
+    outcome = board.outcome()
+    if outcome is not None:
+        evaluation = 0.0 if outcome.winner is None else (100.0 if outcome.winner == chess.WHITE else -100.0)
+        return {'eval': evaluation, 'top_moves': [], 'depth': DEPTH, 'source': 'finished', 'calls': []}
+    
+    if tablebase is None or chess.popcount(board.occupied) > SYZYGY_MAX_PIECES or board.castling_rights:
+        return None
+    try:
+        wdl = tablebase.probe_wdl(board)
+    except KeyError:  # table not in the directory
+        return None
+    evaluation = 100.0 if wdl == 2 else -100.0 if wdl == -2 else 0.0
+    if board.turn == chess.BLACK and evaluation:
+        evaluation = -evaluation
+    return {'eval': evaluation, 'top_moves': [], 'depth': DEPTH, 'source': 'tablebase', 'calls': []}
+
+def carried_mate(previous, move, white_moved):
+    """Analysis of the position after move when the previous one was a forced mate, or None.
+    
+    The mate stands after any move of the losing side and after the winning
+    side's best move, so the position does not need a search.
+    """
+    if previous is None or previous['eval'] is None or abs(previous['eval']) < 100:
+        return None
+    winner_moved = (previous['eval'] > 0) == white_moved
+    if winner_moved and not (previous['top_moves'] and previous['top_moves'][0][0] == move):
+        return None
+    return {'eval': previous['eval'], 'top_moves': [], 'depth': previous['depth'], 'source': 'mate', 'calls': []}
+
+def forced_analysis(board, following):
+    """Analysis of a position with a single legal move, from the one after it."""
+    top_moves = []
+    if following['eval'] is not None:
+        pov = following['eval'] if board.turn == chess.WHITE else -following['eval']
+        top_moves = [(next(iter(board.legal_moves)), pov)]
+    return {'eval': following['eval'], 'top_moves': top_moves, 'depth': following['depth'], 'source': 'forced',
+            'calls': []}
+
+def shortcut_stats(analyses):
+    """Positions of a game answered without the engine, by kind (see SHORTCUT_SOURCES)."""
+    counts = collections.Counter(analysis['source'] for analysis in analyses)
+    return {source: counts[source] for source in SHORTCUT_SOURCES}
+
+def analyse_mainline(game, engine, cache=None, book=None, adaptive=False, stored=None, record=None, budget=None,
+                     tablebase=None):
+    """Search every mainline position once, including the final one.
+    
+    Returns a list of analyses where entry i is the position before ply i,
+    so the "after" evaluation of a move is the "before" evaluation of the next.
+    Every position gets a single-PV search (see search_alternatives for the
+    multipv ones). Positions whose move is in the opening book are not searched. In adaptive
+    mode positions are searched at SHALLOW_DEPTH and only the borderline ones
+    are re-searched at DEPTH (see deepen_adaptive).
+    
+    stored maps plies to analyses kept from an interrupted run, which are not
+    searched again; record(ply, analysis) is called for every new search.
+    
+    With a SearchBudget the positions are probed at up to SHALLOW_DEPTH with
+    BUDGET_PROBE_SHARE of it, then the rest is spread by budget_weights over
+    re-searches at up to DEPTH.
+    
+    Some positions are answered without a search (see SHORTCUT_SOURCES):
+    finished games and tablebase positions up front, positions following a
+    forced mate as the search reaches them, and single legal moves from the
+    analysis of the position after them.
+    """
+    depth = SHALLOW_DEPTH if adaptive or budget is not None else DEPTH
+    book_plies = count_book_plies(game, book)
+    board = game.board()
+    moves = list(game.mainline_moves())
+    white_first = board.turn == chess.WHITE
+    boards = []
+    analyses = []
+    for ply, move in enumerate(moves):
+        if ply < book_plies:
+            analyses.append(book_analysis(board, cache))
+            boards.append(None)
+        else:
+            analyses.append(stored.get(ply) if stored else None)
+            boards.append(board.copy())
+        board.push(move)
+    analyses.append(stored.get(len(boards)) if stored else None)
+    boards.append(board)
+    
+    # Positions that need no search at all
+    forced = []
+    for ply in range(len(boards)):
+        if boards[ply] is None or analyses[ply] is not None:
+            continue
+        analyses[ply] = shortcut_analysis(boards[ply], tablebase)
+        if analyses[ply] is None and ply + 1 < len(boards) and boards[ply].legal_moves.count() == 1:
+            forced.append(ply)
+    
+    def resolve_forced():
+        for ply in reversed(forced):
+            analyses[ply] = forced_analysis(boards[ply], analyses[ply + 1])
+    
+    def search(plies, depth, weights=None, required=True, carry=False):
+        def on_result(index, analysis):
+            if carry:
+                analyses[plies[index]] = analysis
+            if record is not None and analysis['source'] not in SHORTCUT_SOURCES:
+                record(plies[index], analysis)
+        
+        def skip(index):
+            ply = plies[index]
+            if ply == 0:
+                return None
+            return carried_mate(analyses[ply - 1], moves[ply - 1], (ply % 2 == 1) == white_first)
+        
+        return search_positions(engine, [boards[ply] for ply in plies], 1, cache, depth, on_result,
+                                budget, weights, required, skip if carry else None)
+    
+    # The positions are known up front, so they can be searched in any order;
+    # in mainline order a mate found can be carried forward instead of searched
+    plies = [ply for ply in range(len(boards))
+             if boards[ply] is not None and analyses[ply] is None and ply not in forced]
+    if budget is not None:
+        budget.reserved = budget.total * (1 - BUDGET_PROBE_SHARE)
+    for ply, analysis in zip(plies, search(plies, depth, carry=True)):
+        analyses[ply] = analysis
+    
+    if budget is not None:
+        budget.reserved = 0
+        budget.probed += len(plies)
+        weights = budget_weights(boards, analyses, plies)
+        budget.minimal += sum(1 for weight in weights if weight == 0)
+        todo = [(ply, weight) for ply, weight in zip(plies, weights)
+                if weight > 0 and analyses[ply]['depth'] < DEPTH and analyses[ply]['source'] not in SHORTCUT_SOURCES]
+        deep_plies = [ply for ply, _ in todo]
+        for ply, deep in zip(deep_plies, search(deep_plies, DEPTH, [weight for _, weight in todo], False)):
+            if deep is None:
+                continue
+            budget.researched += 1
+            probe = analyses[ply]
+            best = deep if deep['depth'] >= probe['depth'] else probe
+            analyses[ply] = dict(best, calls=probe['calls'] + deep['calls'])
+    
+    resolve_forced()
+    if adaptive:
+        # A forced position stands for the one after it
+        ids = [ply if boards[ply] is not None else None for ply in range(len(analyses))]
+        for ply in reversed(forced):
+            ids[ply] = ids[ply + 1]
+        deepen_adaptive([(ids, game.board().turn)], analyses, lambda plies: search(plies, DEPTH))
+        resolve_forced()
+    return analyses
+
+def positions_to_deepen(ids, analyses, white_first, unstable=()):
+    """Positions of one game that still need a full-depth search.
+    
+    ids lists the position ids of the game in mainline order (None for
+    positions that are never searched, e.g. book positions) and analyses maps
+    ids to their current analysis. A ply is borderline when its eval loss is
+    within ADAPTIVE_MARGIN of an annotation threshold, or when one of its
+    positions is unstable (shallow and deep best moves disagreed).
+    """
+    thresholds = (THRESH_INACCURACY, THRESH_MISTAKE, THRESH_BLUNDER)
+    wanted = set()
+    for ply in range(len(ids) - 1):
+        before_id, after_id = ids[ply], ids[ply + 1]
+        if before_id is None or after_id is None:
+            continue
+        before, after = analyses[before_id], analyses[after_id]
+        if before['depth'] >= DEPTH and after['depth'] >= DEPTH:
+            continue
+        if before_id in unstable or after_id in unstable:
+            borderline = True
+        elif before['eval'] is None or after['eval'] is None:
+            borderline = False
+        else:
+            white_moved = (ply % 2 == 0) == white_first
+            eval_loss = before['eval'] - after['eval'] if white_moved else after['eval'] - before['eval']
+            borderline = any(abs(eval_loss - threshold) <= ADAPTIVE_MARGIN for threshold in thresholds)
+        if borderline:
+            wanted.update(pid for pid in (before_id, after_id) if analyses[pid]['depth'] < DEPTH)
+    return wanted
+
+def deepen_adaptive(sequences, analyses, search):
+    """Re-search borderline positions at full depth until no NAG can change.
+    
+    sequences is a list of (ids, white_first) per game (see positions_to_deepen),
+    analyses maps position ids to analyses and is updated in place, and
+    search(ids) returns the full-depth analyses of those positions. A deepened
+    position whose best move changed marks its neighbours for deepening too.
+    Returns the number of positions re-searched.
+    """
+    unstable = set()
+    deepened = 0
+    while True:
+        todo = set()
+        for ids, white_first in sequences:
+            todo |= positions_to_deepen(ids, analyses, white_first, unstable)
+        if not todo:
+            return deepened
+        todo = list(todo)
+        for pid, deep in zip(todo, search(todo)):
+            shallow = analyses[pid]
+            if shallow['top_moves'] and deep['top_moves'] and shallow['top_moves'][0][0] != deep['top_moves'][0][0]:
+                unstable.add(pid)
+            deep = dict(deep)
+            deep['calls'] = shallow['calls'] + deep['calls']
+            analyses[pid] = deep
+        deepened += len(todo)
+
+def adaptive_stats(analyses):
+    """Engine spend of an adaptive analysis and an estimate of what it saved.
+    
+    The full-depth cost of positions that stayed shallow is estimated from the
+    average cost of the positions that were re-searched at DEPTH. The multipv
+    searches of the best alternatives are the same in both modes and are left out.
+    """
+    calls = [call for analysis in analyses for call in analysis['calls'] if call['multipv'] <= 1]
+    deep_calls = [call for call in calls if call['depth'] >= DEPTH]
+    searched = sum(1 for analysis in analyses if analysis['calls'])
+    shallow_only = searched - len(deep_calls)
+    nodes = sum(call['nodes'] for call in calls)
+    seconds = sum(call['time'] for call in calls)
+    stats = {'positions': searched, 'deepened': len(deep_calls), 'nodes': nodes, 'time': seconds,
+             'saved_nodes': None, 'saved_time': None}
+    if deep_calls:
+        deep_nodes = sum(call['nodes'] for call in deep_calls)
+        deep_time = sum(call['time'] for call in deep_calls)
+        full_nodes = deep_nodes + shallow_only * deep_nodes / len(deep_calls)
+        full_time = deep_time + shallow_only * deep_time / len(deep_calls)
+        stats['saved_nodes'] = max(0, full_nodes - nodes)
+        stats['saved_time'] = max(0.0, full_time - seconds)
+    return stats
+
+class SearchBudget:
+    """Engine time (seconds) or node budget of a game, shared out call by call.
+    
+    Each search is limited to a share of what is left, so searches that stop
+    early (reaching their depth cap) leave more for the later ones. The real
+    spend is taken from the instrumented engine calls.
+    """
+    
+    def __init__(self, kind, total):
+        self.kind = kind  # 'time' or 'nodes'
+        self.total = total
+        self.spent = 0
+        self.reserved = 0  # held back for a later pass
+        self.calls = 0
+        self.probed = 0
+        self.researched = 0
+        self.minimal = 0  # forced, finished or decided positions
+    
+    def remaining(self):
+        return self.total - self.reserved - self.spent
+    
+    def limit(self, weight, pending_weight, depth):
+        """Search limit for a position with weight out of pending_weight still to search."""
+        share = max(0, self.remaining()) * weight / pending_weight if pending_weight > 0 else 0
+        if self.kind == 'time':
+            return chess.engine.Limit(depth=depth, time=max(BUDGET_MIN_TIME, share))
+        return chess.engine.Limit(depth=depth, nodes=max(BUDGET_MIN_NODES, int(share)))
+    
+    def record(self, analysis):
+        if analysis is None:
+            return
+        for call in analysis['calls']:
+            self.spent += call['time'] if self.kind == 'time' else call['nodes']
+            self.calls += 1
+    
+    def stats(self, analyses):
+        """Budget and real spend of a game, for the report."""
+        depths = [analysis['depth'] for analysis in analyses if analysis['source'] != 'book']
+        return {
+            'kind': self.kind,
+            'total': self.total,
+            'spent': self.spent,
+            'calls': self.calls,
+            'probed': self.probed,
+            'researched': self.researched,
+            'minimal': self.minimal,
+            'min_depth': min(depths) if depths else 0,
+            'average_depth': sum(depths) / len(depths) if depths else 0,
+        }
+
+def budget_weights(boards, analyses, plies):
+    """Share of the budget each probed position should get (0: none at all).
     
-    # Clean all nodes in the game tree
-    def clean_node(node):
+    Forced moves, finished games and found mates get nothing more, clearly
+    decided positions (DECIDED_EVAL) little, and the rest more the further
+    their eval is from those of the neighbouring positions.
+    """
+    weights = []
+    for ply in plies:
+        evaluation = analyses[ply]['eval']
+        if boards[ply].legal_moves.count() <= 1 or evaluation is None or abs(evaluation) >= 100:
+            weights.append(0.0)
+        elif abs(evaluation) >= DECIDED_EVAL:
+            weights.append(0.25)
+        else:
+            neighbours = [analyses[other]['eval'] for other in (ply - 1, ply + 1)
+                          if 0 <= other < len(analyses) and analyses[other] is not None
+                          and analyses[other]['eval'] is not None]
+            swings = [min(abs(other - evaluation), DECIDED_EVAL) for other in neighbours]
+            weights.append(1.0 + (sum(swings) / len(swings) if swings else 0.0))
+    return weights
+
+class MainlineGameBuilder(chess.pgn.GameBuilder):
+    """PGN visitor that keeps only the headers and the mainline moves.
+    
+    Comments, NAGs and side variations are dropped while parsing, so the game
+    comes out already clean (see clean_game_annotations) without building the
+    full tree first.
+    """
+    
+    def begin_variation(self):
+        return chess.pgn.SKIP
+    
+    def end_variation(self):
+        pass  # nothing was pushed by begin_variation
+    
+    def visit_comment(self, comment):
+        pass
+    
+    def visit_nag(self, nag):
+        pass
+
+class TreeGameBuilder(chess.pgn.GameBuilder):
+    """PGN visitor that keeps the headers and the whole move tree, without comments or NAGs."""
+    
+    def visit_comment(self, comment):
+        pass
+    
+    def visit_nag(self, nag):
+        pass
+
+def read_mainline_game(handle):
+    """Read the next game of a PGN file as headers plus clean mainline, or None."""
+    return chess.pgn.read_game(handle, Visitor=MainlineGameBuilder)
+
+def read_tree_game(handle):
+    """Read the next game of a PGN file with its side variations (but no comments or NAGs), or None."""
+    return chess.pgn.read_game(handle, Visitor=TreeGameBuilder)
+
+def clean_game_annotations(game):
+    """Remove all existing comments, NAGs and side variations from the game."""
+    # Walk the main line iteratively: long games would hit the recursion limit
+    node = game
+    while True:
         node.comment = ""
         node.nags.clear()
-        for variation in node.variations:
-            clean_node(variation)
+        if not node.variations:
+            break
+        node.variations = [node.variations[0]]
+        node = node.variations[0]
     
-    clean_node(game)
+    return game
+
+def annotate_game(game, engine, cache=None, book=None, adaptive=False, stored=None, record=None, budget=None,
+                  tablebase=None, variations=False):
+    """Annotate the game with Stockfish evaluations - ONLY negative annotations.
     
-    # Keep only main line variations
-    def keep_mainline_only(node):
-        if node.variations:
-            main_variation = node.variations[0]
-            node.variations = [main_variation]
-            keep_mainline_only(main_variation)
+    With variations the side variations of the game are annotated too.
+    """
+    print(f"Analyzing game... (this may take a while)")
+    analyses = analyse_mainline(game, engine, cache, book, adaptive, stored, record, budget, tablebase)
+    sidelines = analyse_sidelines(game, engine, analyses, cache, tablebase) if variations else None
+    # A budget is spent by the mainline searches: its flagged moves keep their best line only
+    alternatives = search_alternatives(engine, game, analyses, cache, record) if budget is None else None
+    game, stats, annotated_moves = annotate_from_analyses(game, analyses)
+    if alternatives is not None:
+        stats['alternatives'] = alternatives
+    if sidelines is not None:
+        stats['sidelines'] = annotate_sidelines(*sidelines)
+    if budget is not None:
+        stats['budget'] = budget.stats(analyses)
+    if cache is not None:
+        stats['cache'] = cache_stats(analyses)
+    if adaptive:
+        stats['adaptive'] = adaptive_stats(analyses)
+    return game, stats, annotated_moves
+
+def analyse_sidelines(game, engine, analyses, cache=None, tablebase=None):
+    """Search the positions of the side variations, each unique position once.
     
-    keep_mainline_only(game)
+    The whole tree is walked depth-first on a single board (push/pop). The
+    main line comes first, so branch points and transpositions into it reuse
+    its analyses; positions reached by several lines are searched once. The
+    cost grows with the number of unique positions, not of lines.
     
-    return game
+    Returns (moves, known, searched): moves lists the sideline moves as
+    (node, key of the position before, key after, ply, side, move number),
+    known maps position keys to analyses and searched lists the keys that
+    were searched for the side variations.
+    """
+    offset = 0 if game.board().turn == chess.WHITE else 1
+    board = game.board()
+    root_key = position_key(board)
+    known = {root_key: analyses[0]}
+    moves = []
+    boards = {}
+    
+    stack = [(node, rank == 0, 0, root_key) for rank, node in reversed(list(enumerate(game.variations)))]
+    while stack:
+        entry = stack.pop()
+        if entry is None:  # all lines below this move are done
+            board.pop()
+            continue
+        node, mainline, ply, parent_key = entry
+        board.push(node.move)
+        key = position_key(board)
+        if mainline:
+            known[key] = analyses[ply + 1]
+        else:
+            moves.append((node, parent_key, key, ply, (ply + offset) % 2, (ply + offset) // 2 + 1))
+            if key not in known and key not in boards:
+                boards[key] = board.copy()
+        stack.append(None)
+        stack.extend((child, mainline and rank == 0, ply + 1, key)
+                     for rank, child in reversed(list(enumerate(node.variations))))
+    
+    for key in list(boards):
+        analysis = shortcut_analysis(boards[key], tablebase)
+        if analysis is not None:
+            known[key] = analysis
+            del boards[key]
+    for key, analysis in zip(list(boards), search_positions(engine, list(boards.values()), 1, cache)):
+        known[key] = analysis
+    return moves, known, list(boards)
 
-def annotate_game(game, engine):
-    """Annotate the game with Stockfish evaluations - ONLY negative annotations."""
+def annotate_sidelines(moves, known, searched):
+    """Put the negative annotations on the moves of the side variations (see analyse_sidelines).
+    
+    Moves are classified like those of the main line. Returns the sideline
+    statistics, with the annotated moves listed like annotate_from_analyses does.
+    """
+    table = new_eval_table()
+    for _, before, after, ply, side, move_number in moves:
+        append_eval_row(table, known[before], known[after], ply, side, move_number)
+    scores = score_eval_table(table)
+    
+    symbols = {nag: symbol for symbol, nag in ANNOTATIONS.items()}
+    annotated_moves = []
+    for index, (node, _, _, _, side, move_number) in enumerate(moves):
+        node.nags.clear()
+        nag = int(scores['nag'][index])
+        if nag:
+            node.nags.add(nag)
+            annotated_moves.append({
+                'move_number': move_number,
+                'player': 'White' if side == 0 else 'Black',
+                'move': node.san(),
+                'annotation': symbols[nag],
+                'eval_change': float(scores['eval_change'][index]),
+            })
+    
+    return {
+        'moves': len(moves),
+        'positions': len({after for _, _, after, _, _, _ in moves}),
+        'searched': len(searched),
+        'time': sum(call['time'] for key in searched for call in known[key]['calls']),
+        'annotated_moves': annotated_moves,
+    }
+
+def flagged_plies(game, analyses):
+    """Plies whose move gets a negative annotation (see annotate_from_analyses)."""
+    offset = 0 if game.board().turn == chess.WHITE else 1
+    plies = range(len(analyses) - 1)
+    table = append_eval_rows(new_eval_table(), analyses, [(ply + offset) % 2 for ply in plies],
+                             [(ply + offset) // 2 + 1 for ply in plies])
+    nags = score_eval_table(table)['nag']
+    return [ply for ply in plies if nags[ply]]
+
+def needs_alternatives(board, analysis):
+    """Whether a position still lacks the multipv lines of its best alternatives."""
+    return len(analysis['top_moves']) < min(TOP_MOVES, board.legal_moves.count())
+
+def with_alternatives(analysis, alternatives):
+    """A position analysis with the top moves and lines of a multipv search of it.
+    
+    Eval and depth are kept, so the classification of the move is unchanged.
+    """
+    return dict(analysis, top_moves=alternatives['top_moves'], lines=alternatives.get('lines', []),
+                calls=analysis['calls'] + alternatives['calls'])
+
+def search_alternatives(engine, game, analyses, cache=None, record=None):
+    """Search the best alternatives of the annotated moves only.
+    
+    The single-PV mainline pass is enough to classify every move; the multipv
+    search (TOP_MOVES lines) runs only on the positions before a move flagged
+    ?!, ? or ??. Returns how many of them the engine searched and how many
+    were reused (from the cache).
+    """
+    flagged = set(flagged_plies(game, analyses))
+    boards = {}
     board = game.board()
-    node = game
-    move_number = 1
+    for ply, move in enumerate(game.mainline_moves()):
+        if ply in flagged and needs_alternatives(board, analyses[ply]):
+            boards[ply] = board.copy()
+        board.push(move)
     
-    # Statistics tracking - only negative annotations
-    stats = {
-        'white': {6: 0, 2: 0, 4: 0, 'moves': 0, 'total_accuracy': 0.0, 'accuracy_count': 0},
-        'black': {6: 0, 2: 0, 4: 0, 'moves': 0, 'total_accuracy': 0.0, 'accuracy_count': 0},
-        'total_moves': 0
+    counts = {'searched': 0, 'reused': 0}
+    for ply, alternatives in zip(list(boards), search_positions(engine, list(boards.values()), TOP_MOVES, cache)):
+        analyses[ply] = with_alternatives(analyses[ply], alternatives)
+        counts['searched' if alternatives['source'] == 'engine' else 'reused'] += 1
+        if record is not None:
+            record(ply, analyses[ply])
+    return counts
+
+def format_eval(pawns):
+    """Eval comment of a side variation, from White's perspective."""
+    if abs(pawns) >= 100:
+        return "+M" if pawns > 0 else "-M"
+    return f"{pawns:+.2f}"
+
+def add_variations(node, analysis):
+    """Write the engine's best lines instead of node's move as side variations.
+    
+    Each variation starts with a comment giving its eval. Returns the SAN of
+    the best move, or None when it is unknown or the move played.
+    """
+    parent = node.parent
+    board = parent.board()
+    lines = analysis.get('lines', [])
+    for rank, (move, score) in enumerate(analysis['top_moves']):
+        if parent.has_variation(move):  # the move played, or a side variation of the input
+            continue
+        line = lines[rank] if rank < len(lines) and lines[rank][:1] == [move] else [move]
+        white_score = score if board.turn == chess.WHITE else -score
+        variation = parent.add_variation(move, comment=format_eval(white_score))
+        variation.add_line(line[1:])
+    if not analysis['top_moves'] or analysis['top_moves'][0][0] == node.move:
+        return None
+    return board.san(analysis['top_moves'][0][0])
+
+def cache_stats(analyses):
+    """Count the analyses of a game that came from the cache or from the engine."""
+    hits = sum(1 for analysis in analyses if analysis['source'] == 'cache')
+    misses = sum(1 for analysis in analyses if analysis['source'] == 'engine')
+    return {'hits': hits, 'misses': misses}
+
+def engine_metrics(analyses):
+    """Per-call engine instrumentation of a game, plus its totals.
+    
+    Every engine call is listed with the ply of its position, wall time,
+    requested and reached depth, seldepth, nodes and nps.
+    """
+    per_call = [dict(call, ply=ply) for ply, analysis in enumerate(analyses) for call in analysis['calls']]
+    return {
+        'calls': len(per_call),
+        'positions': len(analyses),
+        'time': sum(call['time'] for call in per_call),
+        'nodes': sum(call['nodes'] for call in per_call),
+        'per_call': per_call,
     }
+
+def configure_annotation(inaccuracy=None, mistake=None, blunder=None, skip_moves=None):
+    """Override the annotation thresholds (pawns) and SKIP_MOVES; None keeps a setting."""
+    global THRESH_INACCURACY, THRESH_MISTAKE, THRESH_BLUNDER, SKIP_MOVES
+    if inaccuracy is not None:
+        THRESH_INACCURACY = inaccuracy
+    if mistake is not None:
+        THRESH_MISTAKE = mistake
+    if blunder is not None:
+        THRESH_BLUNDER = blunder
+    if skip_moves is not None:
+        SKIP_MOVES = skip_moves
+
+def annotate_from_analyses(game, analyses):
+    """Annotate the game from per-position analyses (see analyse_mainline).
     
-    annotated_moves = []
+    The evals of the main line are collected in an eval table first; accuracy,
+    classification and the per-player statistics are computed over it at once.
+    The engine's best lines instead of each annotated move are added as side
+    variations.
+    """
+    board = game.board()
+    node = game
+    move_number = 1
     
-    print(f"Analyzing game... (this may take a while)")
+    nodes = []
+    notations = []
+    hashes = []
+    sides = []
+    move_numbers = []
+    book = {'plies': 0, 'exit': None}
     
-    # Process each move in the main line
+    # Walk the main line
     while node.variations:
         current_node = node.variations[0]
         move = current_node.move
-        
-        # Get move notation before playing it
-        move_notation = board.san(move)
         current_player = 'white' if board.turn else 'black'  # Player who is about to move
+        move_notation = board.san(move)
         
-        # Count all moves
-        stats[current_player]['moves'] += 1
-        stats['total_moves'] += 1
-        
-        # Get evaluation before the move (in centipawns from White's perspective)
-        eval_before = evaluate_position(engine, board)
-        
-        # Convert to win percentage from current player's perspective
-        if eval_before is not None:
-            cp_before = eval_before * 100  # Convert back to centipawns
-            if current_player == 'black':
-                cp_before = -cp_before  # Flip for black's perspective
-            win_percent_before = centipawns_to_win_percent(cp_before)
-        else:
-            win_percent_before = None
+        # Book moves are known theory: never annotated
+        if analyses[len(nodes)]['source'] == 'book':
+            book['plies'] += 1
+        elif book['exit'] is None:
+            move_num_str = f"{move_number}." if current_player == 'white' else f"{move_number}..."
+            book['exit'] = f"{move_num_str} {move_notation}"
         
-        # Get top moves for finding the best alternative (for reporting)
-        top_moves = get_top_moves(engine, board, TOP_MOVES)
+        nodes.append(current_node)
+        notations.append(move_notation)
+        hashes.append(chess.polyglot.zobrist_hash(board))
+        sides.append(0 if current_player == 'white' else 1)
+        move_numbers.append(move_number)
         
-        # Play the move
         board.push(move)
-        
-        # Get evaluation after the move
-        eval_after = evaluate_position(engine, board)
-        
-        # Convert to win percentage from current player's perspective
-        if eval_after is not None:
-            cp_after = eval_after * 100  # Convert back to centipawns
-            if current_player == 'black':
-                cp_after = -cp_after  # Flip for black's perspective
-            win_percent_after = centipawns_to_win_percent(cp_after)
-        else:
-            win_percent_after = None
-        
-        # Calculate move accuracy using Lichess formula
-        move_accuracy = None
-        if win_percent_before is not None and win_percent_after is not None:
-            move_accuracy = calculate_move_accuracy(win_percent_before, win_percent_after)
-            stats[current_player]['total_accuracy'] += move_accuracy
-            stats[current_player]['accuracy_count'] += 1
-        
-        # Clear any existing NAGs
-        current_node.nags.clear()
-        
-        # Skip annotating first few opening moves to avoid nonsensical annotations
-        if move_number > 2:
-            # Calculate evaluation change from the moving player's perspective
-            if eval_before is not None and eval_after is not None:
-                # For White moves: positive change = good for White
-                # For Black moves: negative change in White's eval = good for Black
-                if current_player == 'white':
-                    eval_change = eval_after - eval_before
-                else:  # black player
-                    eval_change = eval_before - eval_after
-                
-                annotation = None
-                
-                # ONLY apply negative annotations for bad moves (negative eval_change)
-                if eval_change <= -THRESH_BLUNDER:
-                    current_node.nags.add(ANNOTATIONS["??"])
-                    stats[current_player][ANNOTATIONS["??"]] += 1
-                    annotation = "??"
-                elif eval_change <= -THRESH_MISTAKE:
-                    current_node.nags.add(ANNOTATIONS["?"])
-                    stats[current_player][ANNOTATIONS["?"]] += 1
-                    annotation = "?"
-                elif eval_change <= -THRESH_INACCURACY:
-                    current_node.nags.add(ANNOTATIONS["?!"])
-                    stats[current_player][ANNOTATIONS["?!"]] += 1
-                    annotation = "?!"
-                
-                # Track annotated moves for detailed report
-                if annotation:
-                    annotated_moves.append({
-                        'move_number': move_number,
-                        'player': current_player.capitalize(),
-                        'move': move_notation,
-                        'annotation': annotation,
-                        'eval_change': eval_change,
-                        'move_accuracy': move_accuracy
-                    })
-        
-        # Move to next node
         node = current_node
         if board.turn == chess.WHITE:  # Just finished Black's move
             move_number += 1
     
+    table = append_eval_rows(new_eval_table(), analyses, sides, move_numbers)
+    scores = score_eval_table(table)
+    players = aggregate_eval_table(table, scores, games=1)[0]
+    
+    stats = {
+        'white': players['white'],
+        'black': players['black'],
+        'total_moves': len(nodes),
+        'book': book,
+        'shortcuts': shortcut_stats(analyses),
+        'engine': engine_metrics(analyses),
+        'analyses': analyses,
+        'plies': {'table': table, 'scores': scores, 'san': notations, 'hash': hashes, 'headers': dict(game.headers)}
+    }
+    
+    # Apply the negative annotations and list them for the detailed report
+    symbols = {nag: symbol for symbol, nag in ANNOTATIONS.items()}
+    annotated_moves = []
+    for ply, current_node in enumerate(nodes):
+        current_node.nags.clear()
+        nag = int(scores['nag'][ply])
+        if nag:
+            current_node.nags.add(nag)
+            best_move = add_variations(current_node, analyses[ply])
+            move_accuracy = float(scores['accuracy'][ply])
+            annotated_moves.append({
+                'move_number': move_numbers[ply],
+                'player': 'White' if sides[ply] == 0 else 'Black',
+                'move': notations[ply],
+                'annotation': symbols[nag],
+                'eval_change': float(scores['eval_change'][ply]),
+                'move_accuracy': move_accuracy if not math.isnan(move_accuracy) else None,
+                'best_move': best_move,
+            })
+    
     return game, stats, annotated_moves
 
 def generate_report(game, stats, annotated_moves):
@@ -244,13 +1087,92 @@ def generate_report(game, stats, annotated_moves):
     # Analysis settings
     report_lines.append("ANALYSIS SETTINGS:")
     report_lines.append(f"Engine: Stockfish")
-    report_lines.append(f"Depth: {DEPTH}")
+    if 'budget' in stats:
+        report_lines.append(f"Depth: up to {DEPTH} within a {stats['budget']['kind']} budget")
+    elif 'adaptive' in stats:
+        report_lines.append(f"Depth: {DEPTH} (adaptive, shallow depth {SHALLOW_DEPTH}, margin {ADAPTIVE_MARGIN} pawns)")
+    else:
+        report_lines.append(f"Depth: {DEPTH}")
     report_lines.append(f"Accuracy calculation: Lichess formula")
     report_lines.append(f"Inaccuracy threshold: {THRESH_INACCURACY} pawns")
     report_lines.append(f"Mistake threshold: {THRESH_MISTAKE} pawns")
     report_lines.append(f"Blunder threshold: {THRESH_BLUNDER} pawns")
+    report_lines.append(f"Moves not annotated: first {SKIP_MOVES} of each side")
+    if 'reannotated' in stats:
+        report_lines.append(f"Evaluations: stored in {stats['reannotated']['path']} "
+                            f"(depth {stats['reannotated']['depth']} or more), engine not run")
+    elif 'cache' in stats:
+        lookups = stats['cache']['hits'] + stats['cache']['misses']
+        hit_rate = (stats['cache']['hits'] / lookups) * 100 if lookups > 0 else 0
+        report_lines.append(f"Evaluation cache: {stats['cache']['hits']} hits, "
+                            f"{stats['cache']['misses']} misses ({hit_rate:.1f}% hit rate)")
+    else:
+        report_lines.append("Evaluation cache: disabled")
+    alternatives = stats.get('alternatives')
+    if alternatives and alternatives['searched'] + alternatives['reused'] > 0:
+        report_lines.append(f"Best alternatives: {alternatives['searched'] + alternatives['reused']} annotated moves, "
+                            f"up to {TOP_MOVES} lines each ({alternatives['searched']} searched, "
+                            f"{alternatives['reused']} reused)")
+    if 'sidelines' in stats:
+        sidelines = stats['sidelines']
+        report_lines.append(f"Side variations: {sidelines['moves']} moves reaching {sidelines['positions']} distinct "
+                            f"positions ({sidelines['searched']} searched, {sidelines['time']:.1f}s)")
+    skipped = sum(stats['shortcuts'].values())
+    if skipped > 0:
+        kinds = ", ".join(f"{description}: {stats['shortcuts'][source]}"
+                          for source, description in SHORTCUT_SOURCES.items() if stats['shortcuts'][source] > 0)
+        report_lines.append(f"Searches skipped: {skipped} ({kinds})")
+    if stats['book']['plies'] > 0:
+        if stats['book']['exit'] is not None:
+            report_lines.append(f"Opening book: left book at {stats['book']['exit']} "
+                                f"(book plies: {stats['book']['plies']})")
+        else:
+            report_lines.append(f"Opening book: all {stats['book']['plies']} plies in book")
     report_lines.append("")
     
+    if 'adaptive' in stats:
+        adaptive = stats['adaptive']
+        report_lines.append("ADAPTIVE DEPTH:")
+        report_lines.append(f"Positions searched: {adaptive['positions']}")
+        report_lines.append(f"Re-searched at depth {DEPTH}: {adaptive['deepened']}")
+        report_lines.append(f"Nodes searched: {adaptive['nodes']:,}")
+        report_lines.append(f"Engine time: {adaptive['time']:.1f}s")
+        if adaptive['saved_nodes'] is not None:
+            report_lines.append(f"Estimated nodes saved: {adaptive['saved_nodes']:,.0f}")
+            report_lines.append(f"Estimated time saved: {adaptive['saved_time']:.1f}s")
+        report_lines.append("")
+    
+    if 'budget' in stats:
+        budget = stats['budget']
+        if budget['kind'] == 'time':
+            given, spent = f"{budget['total']:.1f}s of engine time", f"{budget['spent']:.1f}s"
+        else:
+            given, spent = f"{budget['total']:,.0f} nodes", f"{budget['spent']:,.0f} nodes"
+        report_lines.append("BUDGET:")
+        report_lines.append(f"Budget: {given}")
+        report_lines.append(f"Spent: {spent} ({budget['spent'] / budget['total'] * 100 if budget['total'] else 0:.1f}%) "
+                            f"in {budget['calls']} engine calls")
+        report_lines.append(f"Positions probed (depth up to {SHALLOW_DEPTH}): {budget['probed']}")
+        report_lines.append(f"Re-searched (depth up to {DEPTH}): {budget['researched']}")
+        report_lines.append(f"Forced, finished or mate found (probe only): {budget['minimal']}")
+        report_lines.append(f"Depth reached: {budget['average_depth']:.1f} on average, {budget['min_depth']} at least")
+        report_lines.append("")
+    
+    if stats['engine']['calls'] > 0:
+        engine = stats['engine']
+        calls = engine['per_call']
+        report_lines.append("ENGINE METRICS:")
+        report_lines.append(f"Engine calls: {engine['calls']} ({engine['calls'] / max(1, stats['total_moves']):.2f} per ply)")
+        report_lines.append(f"Engine time: {engine['time']:.1f}s ({engine['time'] / engine['calls']:.2f}s per call)")
+        report_lines.append(f"Nodes: {engine['nodes']:,} (average {engine['nodes'] / engine['time'] if engine['time'] > 0 else 0:,.0f} nps)")
+        report_lines.append(f"Average depth reached: {sum(call['depth_reached'] for call in calls) / len(calls):.1f} "
+                            f"(seldepth {sum(call['seldepth'] for call in calls) / len(calls):.1f})")
+        if 'timing' in stats:
+            outside = max(0.0, stats['timing']['analysis'] - engine['time'])
+            report_lines.append(f"PGN parsing: {stats['timing']['parse']:.3f}s")
+            report_lines.append(f"Analysis outside the engine: {outside:.3f}s")
+        report_lines.append("")
+    
     # Summary statistics
     report_lines.append("SUMMARY STATISTICS:")
     report_lines.append(f"Total moves analyzed: {stats['total_moves']}")
@@ -283,6 +1205,8 @@ def generate_report(game, stats, annotated_moves):
             report_lines.append(f"  Average Move Accuracy: {avg_accuracy:.1f}%")
         else:
             report_lines.append("  Average Move Accuracy: N/A")
+        if player_stats.get('game_accuracy') is not None:
+            report_lines.append(f"  Game Accuracy (Lichess): {player_stats['game_accuracy']:.1f}%")
         
         report_lines.append("")
     
@@ -320,66 +1244,1987 @@ def generate_report(game, stats, annotated_moves):
             move_num_str = f"{move_info['move_number']}." if move_info['player'] == 'White' else f"{move_info['move_number']}..."
             accuracy_str = f" (Accuracy: {move_info['move_accuracy']:.1f}%)" if move_info.get('move_accuracy') is not None else ""
             
+            best_str = f" - Best: {move_info['best_move']}" if move_info.get('best_move') else ""
+            
             report_lines.append(f"{move_num_str} {move_info['move']} {move_info['annotation']} "
-                              f"({move_info['player']}) - Lost: {abs(move_info['eval_change']):.2f} pawns{accuracy_str}")
+                              f"({move_info['player']}) - Lost: {abs(move_info['eval_change']):.2f} pawns{accuracy_str}"
+                              f"{best_str}")
     else:
         report_lines.append("No errors found - excellent play!")
     
+    if stats.get('sidelines', {}).get('annotated_moves'):
+        report_lines.append("")
+        report_lines.append("ERRORS IN SIDE VARIATIONS:")
+        report_lines.append("-" * 50)
+        for move_info in stats['sidelines']['annotated_moves']:
+            move_num_str = f"{move_info['move_number']}." if move_info['player'] == 'White' else f"{move_info['move_number']}..."
+            report_lines.append(f"{move_num_str} {move_info['move']} {move_info['annotation']} "
+                                f"({move_info['player']}) - Lost: {abs(move_info['eval_change']):.2f} pawns")
+    
     return "\n".join(report_lines)
 
+# ---------------- EVAL TABLE ----------------
+
+# Columns of an eval table: one entry per mainline ply, for one game or a batch
+EVAL_COLUMNS = {
+    'game': 'l',  # index of the game in the batch
+    'ply': 'l',
+    'side': 'b',  # 0 = White moved, 1 = Black moved
+    'move_number': 'l',
+    'cp_before': 'd',  # centipawns from White's perspective, NaN when unknown
+    'cp_after': 'd',
+    'mate_before': 'b',  # the evaluation is a forced mate (clamped to +/-100 pawns)
+    'mate_after': 'b',
+    'book': 'b',  # book move: never annotated
+}
+
+def new_eval_table():
+    """Empty eval table: one compact array per column."""
+    return {name: array.array(code) for name, code in EVAL_COLUMNS.items()}
+
+def append_eval_rows(table, analyses, sides, move_numbers, game_index=0):
+    """Append the plies of one game to an eval table.
+    
+    analyses are the per-position analyses of analyse_mainline; sides and
+    move_numbers give the mover (0 White, 1 Black) and move number of each ply.
+    """
+    for ply, (side, move_number) in enumerate(zip(sides, move_numbers)):
+        append_eval_row(table, analyses[ply], analyses[ply + 1], ply, side, move_number, game_index)
+    return table
+
+def append_eval_row(table, before, after, ply, side, move_number, game_index=0):
+    """Append one move to an eval table, from the analyses of the positions before and after it."""
+    eval_before = before['eval']
+    eval_after = after['eval']
+    table['game'].append(game_index)
+    table['ply'].append(ply)
+    table['side'].append(side)
+    table['move_number'].append(move_number)
+    table['cp_before'].append(eval_before * 100 if eval_before is not None else math.nan)
+    table['cp_after'].append(eval_after * 100 if eval_after is not None else math.nan)
+    table['mate_before'].append(eval_before is not None and abs(eval_before) >= 100)
+    table['mate_after'].append(eval_after is not None and abs(eval_after) >= 100)
+    table['book'].append(before['source'] == 'book')
+
+def score_eval_table(table):
+    """Win%, move accuracy, eval change and NAG of every ply of an eval table.
+    
+    Win% and accuracy are from the mover's perspective (Lichess formulas),
+    eval_change in pawns; all three are NaN when an eval is unknown. Computed
+    in vectorized passes when NumPy is installed.
+    """
+    if np is None:
+        return _score_eval_table_python(table)
+    
+    sign = np.where(np.asarray(table['side']) == 0, 1.0, -1.0)
+    cp_before = np.asarray(table['cp_before'])
+    cp_after = np.asarray(table['cp_after'])
+    win_before = 50 + 50 * (2 / (1 + np.exp(-0.00368208 * (sign * cp_before))) - 1)
+    win_after = 50 + 50 * (2 / (1 + np.exp(-0.00368208 * (sign * cp_after))) - 1)
+    win_loss = np.maximum(win_before - win_after, 0)
+    accuracy = np.clip(103.1668 * np.exp(-0.04354 * win_loss) - 3.1669, 0, 100)
+    eval_change = sign * (cp_after / 100 - cp_before / 100)
+    
+    # Skip the first few opening moves and book moves
+    classify = (np.asarray(table['move_number']) > SKIP_MOVES) & (np.asarray(table['book']) == 0) & ~np.isnan(eval_change)
+    nag = np.select([eval_change <= -THRESH_BLUNDER, eval_change <= -THRESH_MISTAKE, eval_change <= -THRESH_INACCURACY],
+                    [ANNOTATIONS["??"], ANNOTATIONS["?"], ANNOTATIONS["?!"]], 0)
+    nag = np.where(classify, nag, 0).astype(np.int8)
+    
+    return {'win_before': win_before, 'win_after': win_after, 'accuracy': accuracy,
+            'eval_change': eval_change, 'nag': nag}
+
+def _score_eval_table_python(table):
+    """score_eval_table without NumPy, one ply at a time."""
+    scores = {'win_before': array.array('d'), 'win_after': array.array('d'), 'accuracy': array.array('d'),
+              'eval_change': array.array('d'), 'nag': array.array('b')}
+    for side, move_number, cp_before, cp_after, book in zip(table['side'], table['move_number'], table['cp_before'],
+                                                            table['cp_after'], table['book']):
+        sign = 1 if side == 0 else -1
+        win_before = centipawns_to_win_percent(sign * cp_before) if not math.isnan(cp_before) else math.nan
+        win_after = centipawns_to_win_percent(sign * cp_after) if not math.isnan(cp_after) else math.nan
+        known = not math.isnan(win_before) and not math.isnan(win_after)
+        eval_change = sign * (cp_after / 100 - cp_before / 100)
+        
+        nag = 0
+        if move_number > SKIP_MOVES and not book and known:
+            if eval_change <= -THRESH_BLUNDER:
+                nag = ANNOTATIONS["??"]
+            elif eval_change <= -THRESH_MISTAKE:
+                nag = ANNOTATIONS["?"]
+            elif eval_change <= -THRESH_INACCURACY:
+                nag = ANNOTATIONS["?!"]
+        
+        scores['win_before'].append(win_before)
+        scores['win_after'].append(win_after)
+        scores['accuracy'].append(calculate_move_accuracy(win_before, win_after) if known else math.nan)
+        scores['eval_change'].append(eval_change)
+        scores['nag'].append(nag)
+    return scores
+
+def volatility_weights(table):
+    """Lichess game accuracy weight of every ply of an eval table.
+    
+    A move is weighted by the volatility of its game around it: the standard
+    deviation of White's win% over a window of positions (2 to 8 positions,
+    a tenth of the game), clamped to 0.5-12. Unknown evals repeat the previous
+    one, or 0.00 at the start of a game.
+    """
+    rows = len(table['game'])
+    if np is not None and rows > 0:
+        game = np.asarray(table['game'])
+        new_game = np.r_[True, game[1:] != game[:-1]]
+        first_row = np.flatnonzero(new_game)
+        ordinal = np.cumsum(new_game) - 1
+        last_row = np.r_[first_row[1:], rows] - 1
+        
+        # Positions of all games end to end: before every ply, plus after the last one
+        cp = np.empty(rows + len(first_row))
+        cp[np.arange(rows) + ordinal] = np.asarray(table['cp_before'])
+        cp[last_row + np.arange(len(first_row)) + 1] = np.asarray(table['cp_after'])[last_row]
+        start = np.zeros(len(cp), dtype=bool)
+        start[first_row + np.arange(len(first_row))] = True
+        known = ~np.isnan(cp)
+        previous = np.maximum.accumulate(np.where(known | start, np.arange(len(cp)), 0))
+        win = 50 + 50 * (2 / (1 + np.exp(-0.00368208 * np.where(known[previous], cp[previous], 0.0))) - 1)
+        
+        # Windowed standard deviation from running sums
+        sums = np.r_[0.0, np.cumsum(win)]
+        squares = np.r_[0.0, np.cumsum(win * win)]
+        game_start = (first_row + np.arange(len(first_row)))[ordinal]
+        window = np.clip((last_row - first_row + 1) // 10, 2, 8)[ordinal]
+        end = game_start + np.maximum(window, np.arange(rows) - first_row[ordinal] + 2)
+        mean = (sums[end] - sums[end - window]) / window
+        variance = np.maximum((squares[end] - squares[end - window]) / window - mean * mean, 0)
+        return np.clip(np.sqrt(variance), 0.5, 12)
+    
+    weights = array.array('d')
+    first = 0
+    while first < rows:
+        last = first
+        while last + 1 < rows and table['game'][last + 1] == table['game'][first]:
+            last += 1
+        n = last - first + 1
+        window = min(max(n // 10, 2), 8)
+        win = []
+        for value in list(table['cp_before'][first:last + 1]) + [table['cp_after'][last]]:
+            win.append(centipawns_to_win_percent(value) if not math.isnan(value) else (win[-1] if win else 50.0))
+        for ply in range(n):
+            end = max(window, ply + 2)
+            mean = sum(win[end - window:end]) / window
+            variance = sum((value - mean) ** 2 for value in win[end - window:end]) / window
+            weights.append(min(12.0, max(0.5, math.sqrt(variance))))
+        first = last + 1
+    return weights
+
+def aggregate_eval_table(table, scores, games=None):
+    """Per-player totals of every game of an eval table.
+    
+    Returns one {'white': ..., 'black': ...} dict per game, each player with
+    the count of every NAG, moves, total_accuracy, accuracy_count and the
+    Lichess game_accuracy.
+    """
+    if games is None:
+        games = max(table['game']) + 1 if len(table['game']) else 0
+    size = 2 * games
+    
+    weights = volatility_weights(table)
+    if np is not None:
+        weights = np.asarray(weights)
+        key = np.asarray(table['game'], dtype=np.int64) * 2 + np.asarray(table['side'])
+        accuracy = np.asarray(scores['accuracy'])
+        nags = np.asarray(scores['nag'])
+        known = ~np.isnan(accuracy)
+        moves = np.bincount(key, minlength=size)
+        total_accuracy = np.bincount(key[known], weights=accuracy[known], minlength=size)
+        accuracy_count = np.bincount(key[known], minlength=size)
+        nag_counts = {nag: np.bincount(key[nags == nag], minlength=size) for nag in NAG_NAMES}
+        weighted_accuracy = np.bincount(key[known], weights=accuracy[known] * weights[known], minlength=size)
+        total_weight = np.bincount(key[known], weights=weights[known], minlength=size)
+        inverse_accuracy = np.bincount(key[known], weights=1 / np.maximum(accuracy[known], 1), minlength=size)
+    else:
+        moves = [0] * size
+        total_accuracy = [0.0] * size
+        accuracy_count = [0] * size
+        nag_counts = {nag: [0] * size for nag in NAG_NAMES}
+        weighted_accuracy = [0.0] * size
+        total_weight = [0.0] * size
+        inverse_accuracy = [0.0] * size
+        for game, side, accuracy, nag, weight in zip(table['game'], table['side'], scores['accuracy'],
+                                                     scores['nag'], weights):
+            key = 2 * game + side
+            moves[key] += 1
+            if not math.isnan(accuracy):
+                total_accuracy[key] += accuracy
+                accuracy_count[key] += 1
+                weighted_accuracy[key] += accuracy * weight
+                total_weight[key] += weight
+                inverse_accuracy[key] += 1 / max(accuracy, 1)
+            if nag:
+                nag_counts[nag][key] += 1
+    
+    players = []
+    for game in range(games):
+        player_stats = {}
+        for side, player in enumerate(('white', 'black')):
+            key = 2 * game + side
+            player_stats[player] = {nag: int(nag_counts[nag][key]) for nag in NAG_NAMES}
+            player_stats[player].update({
+                'moves': int(moves[key]),
+                'total_accuracy': float(total_accuracy[key]),
+                'accuracy_count': int(accuracy_count[key]),
+                'game_accuracy': None,
+            })
+            if accuracy_count[key] > 0:
+                # Lichess: average of the volatility-weighted and the harmonic mean
+                weighted = min(100.0, max(0.0, weighted_accuracy[key] / total_weight[key]))
+                harmonic = accuracy_count[key] / inverse_accuracy[key]
+                player_stats[player]['game_accuracy'] = float(weighted + harmonic) / 2
+        players.append(player_stats)
+    return players
+
+# ---------------- ENGINE POOL ----------------
+
+class EnginePool:
+    """K Stockfish processes driven through the asyncio engine API.
+    
+    analyse_many() spreads independent positions (e.g. the mainline of one
+    game) over the engines and returns the analyses in input order. The pool
+    owns its event loop, so it can be used from ordinary synchronous code.
+    """
+    
+    def __init__(self, size=GAME_ENGINES, hash_mb=ENGINE_HASH):
+        self.loop = asyncio.new_event_loop()
+        self.engines = []
+        try:
+            for _ in range(size):
+                _, engine = self.loop.run_until_complete(chess.engine.popen_uci(STOCKFISH_PATH))
+                self.engines.append(engine)
+                self.loop.run_until_complete(engine.configure({"Threads": ENGINE_THREADS, "Hash": hash_mb}))
+        except BaseException:
+            self.quit()
+            raise
+    
+    def analyse_many(self, boards, n=TOP_MOVES, cache=None, depth=DEPTH, on_result=None, limits=None, skip=None):
+        """Analyse positions concurrently (cache hits are not searched).
+        
+        limits optionally gives the search limit of every position (see
+        analyse_position); skip is asked before each search (see search_positions).
+        """
+        results = [None] * len(boards)
+        pending = []
+        for index, board in enumerate(boards):
+            cached = cache.get(board, depth, n) if cache is not None else None
+            if cached is not None:
+                results[index] = cached
+                if on_result is not None:
+                    on_result(index, cached)
+            else:
+                pending.append(index)
+        
+        self.loop.run_until_complete(self._search(boards, pending, results, n, cache, depth, on_result, limits, skip))
+        return results
+    
+    async def _search(self, boards, pending, results, n, cache, depth, on_result, limits, skip):
+        queue = asyncio.Queue()
+        for index in pending:
+            queue.put_nowait(index)
+        
+        async def drain(engine):
+            global searches_finished
+            while not queue.empty():
+                index = queue.get_nowait()
+                skipped = skip(index) if skip is not None else None
+                if skipped is not None:
+                    results[index] = skipped
+                    if on_result is not None:
+                        on_result(index, skipped)
+                    continue
+                start = time.perf_counter()
+                limit = limits[index] if limits is not None else chess.engine.Limit(depth=depth)
+                info = await engine.analyse(boards[index], limit, multipv=n)
+                searches_finished += 1
+                results[index] = analysis_from_info(boards[index], info, depth, time.perf_counter() - start,
+                                                    limits is not None)
+                if cache is not None:
+                    cache.put(boards[index], results[index]['depth'], n, results[index])
+                if on_result is not None:
+                    on_result(index, results[index])
+        
+        await asyncio.gather(*(drain(engine) for engine in self.engines))
+    
+    def quit(self):
+        for engine in self.engines:
+            try:
+                self.loop.run_until_complete(engine.quit())
+            except chess.engine.EngineTerminatedError:
+                pass
+        self.engines = []
+        self.loop.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.quit()
+
+# ---------------- BATCH ----------------
+
+def open_engine(engines=1, hash_mb=ENGINE_HASH):
+    """Start a Stockfish process configured with the per-worker settings.
+    
+    With engines > 1 an EnginePool is returned instead, so the positions of
+    each game are searched in parallel.
+    """
+    if engines > 1:
+        return EnginePool(engines, hash_mb)
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    engine.configure({"Threads": ENGINE_THREADS, "Hash": hash_mb})
+    return engine
+
+def iter_games(path, offset=0, variations=False):
+    """Read the games of a PGN file one at a time, starting at a file offset.
+    
+    Yields (clean mainline PGN text, offset of the next game) in file order;
+    with variations the side variations are kept.
+    """
+    read_game = read_tree_game if variations else read_mainline_game
+    with open(path, 'r', encoding='utf-8') as f:
+        f.seek(offset)
+        while True:
+            game = read_game(f)
+            if game is None:
+                break
+            yield str(game), f.tell()
+
+def analyse_game_text(engine, pgn_text, cache=None, book=None, adaptive=False, stored=None, record=None, budget=None,
+                      tablebase=None, variations=False):
+    """Clean, annotate and report a single game given as PGN text.
+    
+    Returns (annotated PGN text, report text, stats).
+    """
+    # Comments, NAGs and (unless annotated too) side variations are dropped while parsing
+    start = time.perf_counter()
+    game = (read_tree_game if variations else read_mainline_game)(io.StringIO(pgn_text))
+    parse_time = time.perf_counter() - start
+    print(f"Game loaded: {game.headers.get('White', '?')} vs {game.headers.get('Black', '?')}")
+    
+    start = time.perf_counter()
+    annotated_game, stats, annotated_moves = annotate_game(game, engine, cache, book, adaptive, stored, record, budget,
+                                                           tablebase, variations)
+    stats['timing'] = {'parse': parse_time, 'analysis': time.perf_counter() - start}
+    
+    start = time.perf_counter()
+    report = generate_report(annotated_game, stats, annotated_moves)
+    stats['timing']['report'] = time.perf_counter() - start
+    return str(annotated_game), report, stats
+
+def open_cache(cache_path):
+    """Open the evaluation cache, or return None when caching is disabled."""
+    if cache_path is None:
+        return None
+    return EvalCache(cache_path, CACHE_MAX_ENTRIES)
+
+_worker_engine = None
+_worker_cache = None
+_worker_book = None
+_worker_tablebase = None
+_worker_options = None
+
+def _open_worker(options):
+    global _worker_engine, _worker_cache, _worker_book, _worker_tablebase, _worker_options
+    _worker_options = options
+    configure_annotation(**options['annotation'])
+    _worker_engine = open_engine(options['engines'], options['engine_hash'])
+    _worker_cache = open_cache(options['cache_path'])
+    _worker_book = open_book(options['book_path'])
+    _worker_tablebase = open_tablebase(options['syzygy_path'])
+
+def _init_worker(options):
+    """Pool initializer: give each worker process its own engine, cache connection, book and tablebase."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # not the stop handler of a watch daemon
+    _open_worker(options)
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+def _close_worker():
+    global _worker_engine, _worker_cache, _worker_book, _worker_tablebase
+    if _worker_engine is not None:
+        try:
+            _worker_engine.quit()
+        except chess.engine.EngineError:
+            pass  # the engine died already (e.g. it crashed during the job being given up)
+        finally:
+            _worker_engine = None
+    if _worker_cache is not None:
+        _worker_cache.close()
+        _worker_cache = None
+    if _worker_book is not None:
+        _worker_book.close()
+        _worker_book = None
+    if _worker_tablebase is not None:
+        _worker_tablebase.close()
+        _worker_tablebase = None
+
+def _analyse_in_worker(job):
+    index, pgn_text, stored, budget = job
+    budget = SearchBudget(*budget) if budget is not None else None
+    if _worker_options['checkpoint'] is None:
+        return analyse_game_text(_worker_engine, pgn_text, _worker_cache, _worker_book,
+                                 _worker_options['adaptive'], stored, None, budget, _worker_tablebase,
+                                 _worker_options['variations'])
+    
+    # Log every analysed position so an interrupted game can resume from it
+    with open(Checkpoint(_worker_options['checkpoint']).plies_path(index), 'a', encoding='utf-8') as log:
+        def record(ply, analysis):
+            log.write(json.dumps({'ply': ply, 'analysis': encode_analysis(analysis)}) + "\n")
+            log.flush()
+        return analyse_game_text(_worker_engine, pgn_text, _worker_cache, _worker_book,
+                                 _worker_options['adaptive'], stored, record, budget, _worker_tablebase,
+                                 _worker_options['variations'])
+
+def _analyse_group_in_worker(jobs):
+    return [_analyse_in_worker(job) for job in jobs]
+
+def _analyse_boards_in_worker(boards):
+    return search_positions(_worker_engine, boards, 1, _worker_cache)
+
+def _analyse_boards_shallow_in_worker(boards):
+    return search_positions(_worker_engine, boards, 1, _worker_cache, SHALLOW_DEPTH)
+
+def _analyse_alternatives_in_worker(boards):
+    return search_positions(_worker_engine, boards, TOP_MOVES, _worker_cache)
+
+def analysis_options(cache_path=CACHE_PATH, book_path=BOOK_PATH, adaptive=ADAPTIVE, engines=GAME_ENGINES,
+                     checkpoint=None, annotation=None, syzygy_path=SYZYGY_PATH, engine_hash=ENGINE_HASH,
+                     variations=VARIATIONS):
+    """Settings every worker needs to set up its resources (None disables an item).
+    
+    annotation holds configure_annotation overrides.
+    """
+    return {'cache_path': cache_path, 'book_path': book_path, 'adaptive': adaptive, 'engines': engines,
+            'checkpoint': checkpoint, 'annotation': annotation or {}, 'syzygy_path': syzygy_path,
+            'engine_hash': engine_hash, 'variations': variations}
+
+def search_boards(func, boards, workers, options, batch_size=32):
+    """Run a board-batch worker function over boards, returning analyses in order."""
+    batches = [boards[i:i + batch_size] for i in range(0, len(boards), batch_size)]
+    analyses = []
+    for batch in run_jobs(func, batches, workers, options):
+        analyses.extend(batch)
+    return analyses
+
+def run_jobs(func, items, workers=WORKERS, options=None):
+    """Yield func(item) for every item in input order, spread over worker processes.
+    
+    func runs with the worker's engine, cache and book set up (see _init_worker);
+    with a single worker everything runs in this process. items may be a lazy
+    iterable: only a couple of jobs per worker are read ahead.
+    """
+    if options is None:
+        options = analysis_options()
+    if isinstance(items, list):
+        workers = min(workers, len(items))
+    if workers <= 1:
+        _open_worker(options)
+        try:
+            for item in items:
+                yield func(item)
+        finally:
+            _close_worker()
+        return
+    
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(options,))
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def analyse_games(jobs, workers=WORKERS, options=None):
+    """Analyse games, spread over worker processes, yielding results in input order.
+    
+    jobs yields (game index, PGN text, stored analyses or None, budget or None)
+    and is read lazily; a budget is a (kind, total) pair for SearchBudget.
+    """
+    yield from run_jobs(_analyse_in_worker, jobs, workers, options)
+
+def opening_prefix(pgn_text, plies=ORDER_PLIES):
+    """Starting position and first SAN moves of a clean mainline PGN text (see iter_games)."""
+    headers, _, movetext = pgn_text.partition("\n\n")
+    start = ""
+    for line in headers.splitlines():
+        if line.startswith('[FEN "'):
+            start = line[len('[FEN "'):-len('"]')]
+    # Move numbers and the result are the only tokens starting with a digit (or "*")
+    moves = []
+    nesting = 0  # inside side variations
+    for token in movetext.split():
+        if token == "(":
+            nesting += 1
+        elif token == ")":
+            nesting -= 1
+        elif nesting == 0 and not token[0].isdigit() and token != "*":
+            moves.append(token)
+    return [start] + moves[:plies]
+
+def opening_order(prefixes):
+    """Order games so that those sharing a longer opening prefix are adjacent.
+    
+    Builds a move-prefix trie over the prefixes (see opening_prefix) and
+    returns the game indices in depth-first order; branches are visited in
+    the order they first appear in the input.
+    """
+    root = {}
+    for index, prefix in enumerate(prefixes):
+        node = root
+        for move in prefix:
+            node = node.setdefault(move, {})
+        node.setdefault(None, []).append(index)  # games ending at this node
+    
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.extend(node.get(None, ()))
+        stack.extend(reversed([child for move, child in node.items() if move is not None]))
+    return order
+
+def shared_plies(prefixes, order):
+    """Total opening plies each game shares with the game analysed before it."""
+    total = 0
+    for previous, index in zip(order, order[1:]):
+        shared = 0
+        for a, b in zip(prefixes[previous][1:], prefixes[index][1:]):
+            if a != b:
+                break
+            shared += 1
+        if prefixes[previous][0] == prefixes[index][0]:
+            total += shared
+    return total
+
+def analyse_games_ordered(jobs, order, workers=WORKERS, options=None):
+    """Like analyse_games, but the games are searched in the given order.
+    
+    jobs is a list in input order and order a permutation of its indices (see
+    opening_order). Contiguous runs of the order go to the same worker, so
+    its engine finds the shared positions still in its hash table; results
+    are buffered and yielded in input order.
+    """
+    group_size = max(1, math.ceil(len(order) / (4 * workers)))
+    groups = [order[i:i + group_size] for i in range(0, len(order), group_size)]
+    results = run_jobs(_analyse_group_in_worker, [[jobs[index] for index in group] for group in groups],
+                       workers, options)
+    done = {}
+    next_index = 0
+    for group, group_results in zip(groups, results):
+        done.update(zip(group, group_results))
+        while next_index in done:
+            yield done.pop(next_index)
+            next_index += 1
+
+def build_position_table(games, book_plies=None):
+    """Walk the mainlines of all games and collect their unique positions.
+    
+    Returns (positions, game_keys): positions maps each position key to the
+    first board reaching it, game_keys lists the position keys of every game
+    in mainline order (including the final position). The first book_plies[i]
+    positions of game i are opening book positions: they are not collected
+    and their key is None.
+    """
+    positions = {}
+    game_keys = []
+    for index, game in enumerate(games):
+        skip = book_plies[index] if book_plies else 0
+        board = game.board()
+        keys = []
+        for move in list(game.mainline_moves()) + [None]:
+            if len(keys) < skip:
+                keys.append(None)
+            else:
+                key = position_key(board)
+                if key not in positions:
+                    positions[key] = board.copy()
+                keys.append(key)
+            if move is not None:
+                board.push(move)
+        game_keys.append(keys)
+    return positions, game_keys
+
+def analyse_games_dedup(pgn_texts, workers=WORKERS, options=None):
+    """Like analyse_games, but each position shared between games is searched once.
+    
+    A pre-pass collects the unique mainline positions of the whole batch, those
+    are searched (spread over the workers) and every game is then annotated from
+    the shared results.
+    """
+    if options is None:
+        options = analysis_options()
+    games = []
+    parse_times = []
+    for pgn_text in pgn_texts:
+        start = time.perf_counter()
+        games.append(read_mainline_game(io.StringIO(pgn_text)))
+        parse_times.append(time.perf_counter() - start)
+    
+    book = open_book(options['book_path'])
+    book_plies = [count_book_plies(game, book) for game in games]
+    if book is not None:
+        book.close()
+    
+    positions, game_keys = build_position_table(games, book_plies)
+    total_positions = sum(len(keys) for keys in game_keys)
+    print(f"Unique positions: {len(positions)} of {total_positions} "
+          f"(dedup ratio {total_positions / max(1, len(positions)):.2f}x)")
+    
+    # Finished, tablebase and forced positions are not searched (see analyse_mainline)
+    tablebase = open_tablebase(options['syzygy_path'])
+    last_keys = {keys[-1] for keys in game_keys}
+    shortcuts = {}
+    forced = set()
+    for key, board in positions.items():
+        analysis = shortcut_analysis(board, tablebase)
+        if analysis is not None:
+            shortcuts[key] = analysis
+        elif key not in last_keys and board.legal_moves.count() == 1:
+            forced.add(key)
+    if tablebase is not None:
+        tablebase.close()
+    
+    keys_to_search = [key for key in positions if key not in shortcuts and key not in forced]
+    boards = [positions[key] for key in keys_to_search]
+    search = _analyse_boards_shallow_in_worker if options['adaptive'] else _analyse_boards_in_worker
+    results = dict(zip(keys_to_search, search_boards(search, boards, workers, options)))
+    results.update(shortcuts)
+    
+    if options['adaptive']:
+        def search_deep(keys):
+            return search_boards(_analyse_boards_in_worker, [positions[key] for key in keys], workers, options)
+        sequences = []
+        for game, keys in zip(games, game_keys):
+            # A forced position stands for the one after it
+            ids = list(keys)
+            for index in reversed(range(len(ids) - 1)):
+                if ids[index] in forced:
+                    ids[index] = ids[index + 1]
+            sequences.append((ids, game.board().turn))
+        deepened = deepen_adaptive(sequences, results, search_deep)
+        print(f"Adaptive depth: {deepened} of {len(positions)} unique positions re-searched at depth {DEPTH}")
+    
+    cache = open_cache(options['cache_path'])
+    attributed = set()
+    try:
+        game_analyses = []
+        analysis_times = []
+        for game, keys in zip(games, game_keys):
+            start = time.perf_counter()
+            analyses = []
+            board = game.board()
+            for key, move in zip(keys, list(game.mainline_moves()) + [None]):
+                if key is None:
+                    analyses.append(book_analysis(board, cache))
+                elif key in forced:
+                    analyses.append(None)
+                elif key in attributed:
+                    # Engine calls of a shared position are counted for its first game only
+                    analyses.append(dict(results[key], calls=[]))
+                else:
+                    analyses.append(results[key])
+                    attributed.add(key)
+                if move is not None:
+                    board.push(move)
+            for index in reversed(range(len(keys))):
+                if analyses[index] is None:
+                    analyses[index] = forced_analysis(positions[keys[index]], analyses[index + 1])
+            game_analyses.append(analyses)
+            analysis_times.append(time.perf_counter() - start)
+        
+        # Best alternatives of the annotated moves, each position searched once (see search_alternatives)
+        flagged = []
+        for game, keys, analyses in zip(games, game_keys, game_analyses):
+            flagged.append([ply for ply in flagged_plies(game, analyses)
+                            if keys[ply] is not None and needs_alternatives(positions[keys[ply]], analyses[ply])])
+        flagged_keys = list(dict.fromkeys(keys[ply] for keys, plies in zip(game_keys, flagged) for ply in plies))
+        alternatives = dict(zip(flagged_keys, search_boards(_analyse_alternatives_in_worker,
+                                                            [positions[key] for key in flagged_keys],
+                                                            workers, options)))
+        
+        counted = set()  # alternatives whose engine calls are already counted for a game
+        for game, keys, parse_time, analyses, analysis_time, plies in zip(games, game_keys, parse_times,
+                                                                          game_analyses, analysis_times, flagged):
+            start = time.perf_counter()
+            searched = {'searched': 0, 'reused': 0}  # see search_alternatives
+            for ply in plies:
+                found = alternatives[keys[ply]]
+                if keys[ply] in counted:
+                    found = dict(found, calls=[])
+                counted.add(keys[ply])
+                searched['searched' if found['calls'] else 'reused'] += 1
+                analyses[ply] = with_alternatives(analyses[ply], found)
+            annotated_game, stats, annotated_moves = annotate_from_analyses(game, analyses)
+            stats['alternatives'] = searched
+            if cache is not None:
+                stats['cache'] = cache_stats(analyses)
+            if options['adaptive']:
+                stats['adaptive'] = adaptive_stats(analyses)
+            stats['timing'] = {'parse': parse_time, 'analysis': analysis_time + time.perf_counter() - start}
+            
+            start = time.perf_counter()
+            report = generate_report(annotated_game, stats, annotated_moves)
+            stats['timing']['report'] = time.perf_counter() - start
+            yield str(annotated_game), report, stats
+    finally:
+        if cache is not None:
+            cache.close()
+
+def game_budgets(path, total):
+    """Split a batch budget over the games of a PGN file, in proportion to their plies."""
+    plies = [sum(1 for _ in read_mainline_game(io.StringIO(pgn_text)).mainline_moves())
+             for pgn_text, _ in iter_games(path)]
+    return [total * count / max(1, sum(plies)) for count in plies]
+
+def report_path(report_output, index, multi_game):
+    """Report file for game number index (1-based); numbered only for multi-game input."""
+    if not multi_game:
+        return report_output
+    root, ext = os.path.splitext(report_output)
+    return f"{root}_{index:04d}{ext}"
+
+METRICS_FIELDS = ['game', 'ply', 'depth', 'depth_reached', 'seldepth', 'nodes', 'nps', 'multipv', 'time']
+
+def write_metrics(handle, index, stats, csv_format):
+    """Append the engine metrics of game number index to a metrics file.
+    
+    CSV gets one row per engine call; JSON gets one line per game with its
+    totals, timings and the list of calls.
+    """
+    if csv_format:
+        writer = csv.DictWriter(handle, METRICS_FIELDS)
+        if handle.tell() == 0:
+            writer.writeheader()
+        for call in stats['engine']['per_call']:
+            writer.writerow(dict(call, game=index))
+    else:
+        record = {
+            'game': index,
+            'plies': stats['total_moves'],
+            'engine_calls': stats['engine']['calls'],
+            'engine_time': stats['engine']['time'],
+            'nodes': stats['engine']['nodes'],
+            'timing': stats.get('timing', {}),
+            'calls': stats['engine']['per_call'],
+        }
+        handle.write(json.dumps(record) + "\n")
+    handle.flush()
+
+def stored_depth(analyses):
+    """Depth every searched position of a game was analysed to (at least)."""
+    depths = [analysis['depth'] for analysis in analyses
+              if analysis['source'] not in ('book', 'finished', 'tablebase') and analysis['eval'] is not None]
+    return min(depths) if depths else DEPTH
+
+def write_evals(handle, index, stats):
+    """Append the raw per-ply evaluations of game number index to an evals file.
+    
+    One JSON line per game: its number of plies, the depth it was searched to
+    and the analysis of every position (without the engine call metrics).
+    """
+    analyses = [{key: value for key, value in encode_analysis(analysis).items() if key != 'calls'}
+                for analysis in stats['analyses']]
+    record = {'game': index, 'plies': stats['total_moves'], 'depth': stored_depth(stats['analyses']),
+              'analyses': analyses}
+    handle.write(json.dumps(record) + "\n")
+    handle.flush()
+
+def iter_evals(path):
+    """Read the records of an evals file (see write_evals) one at a time, with the analyses decoded."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            record['analyses'] = [decode_analysis(dict(data, calls=[])) for data in record['analyses']]
+            yield record
+
+# ---------------- EXPORT ----------------
+
+# Columns of a ply export: (name, struct format, NumPy dtype), little-endian
+EXPORT_COLUMNS = [
+    ('game', 'I', '<u4'),  # game number (1-based, input order)
+    ('ply', 'H', '<u2'),
+    ('side', 'B', 'u1'),  # 0 = White moved, 1 = Black
+    ('san', '8s', 'S8'),
+    ('fen_hash', 'Q', '<u8'),  # Zobrist hash of the position before the move
+    ('eval_before', 'f', '<f4'),  # pawns from White's perspective, NaN when unknown
+    ('eval_after', 'f', '<f4'),
+    ('win_before', 'f', '<f4'),  # win% of the mover
+    ('win_after', 'f', '<f4'),
+    ('accuracy', 'f', '<f4'),
+    ('nag', 'B', 'u1'),  # 0 when not annotated
+    ('best_move', '5s', 'S5'),  # UCI, empty when unknown
+    ('depth', 'B', 'u1'),
+    ('nodes', 'Q', '<u8'),  # searched for the position before the move
+]
+
+def ply_export_rows(index, stats):
+    """Columns of the analysed plies of game number index (see EXPORT_COLUMNS)."""
+    plies = stats['plies']
+    table, scores, analyses = plies['table'], plies['scores'], stats['analyses']
+    rows = {name: [] for name, _, _ in EXPORT_COLUMNS}
+    for ply in range(stats['total_moves']):
+        analysis = analyses[ply]
+        rows['game'].append(index)
+        rows['ply'].append(ply)
+        rows['side'].append(table['side'][ply])
+        rows['san'].append(plies['san'][ply].encode())
+        rows['fen_hash'].append(plies['hash'][ply])
+        rows['eval_before'].append(table['cp_before'][ply] / 100)
+        rows['eval_after'].append(table['cp_after'][ply] / 100)
+        rows['win_before'].append(float(scores['win_before'][ply]))
+        rows['win_after'].append(float(scores['win_after'][ply]))
+        rows['accuracy'].append(float(scores['accuracy'][ply]))
+        rows['nag'].append(int(scores['nag'][ply]))
+        rows['best_move'].append(analysis['top_moves'][0][0].uci().encode() if analysis['top_moves'] else b"")
+        rows['depth'].append(min(analysis['depth'], 255))
+        rows['nodes'].append(sum(call['nodes'] for call in analysis['calls']))
+    return rows
+
+class PlyExport:
+    """Append-only columnar export of every analysed ply, for dashboards.
+    
+    A directory with one fixed-width binary file per column (<name>.bin, see
+    EXPORT_COLUMNS), the schema (columns.json) and a small index with one JSON
+    line per game (games.jsonl: first row, row count and headers). A game's
+    index line is written after its rows, so rows left by a crash are never
+    indexed; they are cut off when the export is reopened.
+    """
+    
+    def __init__(self, path, keep_games=0):
+        """Open an export directory, keeping only its first keep_games games."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "columns.json"), "w", encoding="utf-8") as f:
+            json.dump({'columns': [{'name': name, 'dtype': dtype} for name, _, dtype in EXPORT_COLUMNS]}, f, indent=2)
+        
+        kept = []
+        index_path = os.path.join(path, "games.jsonl")
+        if keep_games and os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if entry['game'] > keep_games:
+                        break
+                    kept.append(entry)
+        self.rows = kept[-1]['first_row'] + kept[-1]['rows'] if kept else 0
+        
+        self.index = open(index_path, "w", encoding="utf-8")
+        for entry in kept:
+            self.index.write(json.dumps(entry) + "\n")
+        self.columns = {}
+        for name, code, _ in EXPORT_COLUMNS:
+            handle = open(os.path.join(path, f"{name}.bin"), "ab")
+            handle.truncate(self.rows * struct.calcsize("<" + code))
+            self.columns[name] = handle
+    
+    def append(self, index, stats):
+        """Write the plies of game number index, then its index line."""
+        rows = ply_export_rows(index, stats)
+        count = len(rows['game'])
+        for name, code, _ in EXPORT_COLUMNS:
+            layout = "<" + code * count if code.endswith("s") else f"<{count}{code}"
+            self.columns[name].write(struct.pack(layout, *rows[name]))
+            self.columns[name].flush()
+        entry = {'game': index, 'first_row': self.rows, 'rows': count}
+        headers = stats['plies']['headers']
+        entry.update({name.lower(): headers.get(name, "?") for name in ("White", "Black", "Event", "Date", "Result")})
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+        self.rows += count
+    
+    def close(self):
+        for handle in self.columns.values():
+            handle.close()
+        self.index.close()
+
+def read_ply_export(path):
+    """Memory-map a ply export: returns ({column: array}, [game index entries]).
+    
+    The columns are NumPy memmaps, so a scan only reads the pages it touches.
+    """
+    if np is None:
+        raise ImportError("reading a ply export needs NumPy")
+    with open(os.path.join(path, "columns.json"), "r", encoding="utf-8") as f:
+        schema = json.load(f)
+    with open(os.path.join(path, "games.jsonl"), "r", encoding="utf-8") as f:
+        games = [json.loads(line) for line in f]
+    rows = games[-1]['first_row'] + games[-1]['rows'] if games else 0
+    
+    columns = {}
+    for column in schema['columns']:
+        dtype = np.dtype(column['dtype'])
+        if rows == 0:
+            columns[column['name']] = np.zeros(0, dtype)
+        else:
+            columns[column['name']] = np.memmap(os.path.join(path, f"{column['name']}.bin"), dtype, mode="r",
+                                                shape=(rows,))
+    return columns, games
+
+# ---------------- AGGREGATE ----------------
+
+class AccuracySketch:
+    """Streaming mean and percentiles of accuracies (0-100) in bounded memory.
+    
+    Values are counted in bins of SKETCH_RESOLUTION points: at most
+    100 / SKETCH_RESOLUTION + 1 counters, however many values are added.
+    """
+    
+    def __init__(self):
+        self.bins = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+    
+    def add(self, value):
+        self.bins[int(min(100.0, max(0.0, value)) / SKETCH_RESOLUTION)] += 1
+        self.count += 1
+        self.total += value
+    
+    def mean(self):
+        return self.total / self.count if self.count else None
+    
+    def percentile(self, p):
+        """Nearest-rank percentile p (0-100), as the middle of its bin; None when empty."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen >= rank:
+                return min(100.0, (index + 0.5) * SKETCH_RESOLUTION)
+
+class RunningTotals:
+    """Running statistics of the moves of one player, event or colour."""
+    
+    def __init__(self):
+        self.games = 0
+        self.moves = 0
+        self.nags = {nag: 0 for nag in NAG_NAMES}
+        self.total_accuracy = 0.0
+        self.accuracy_count = 0
+        self.game_accuracy = AccuracySketch()
+    
+    def add(self, player_stats, games=1):
+        """Add one side of a game (player_stats as in annotate_from_analyses)."""
+        self.games += games
+        self.moves += player_stats['moves']
+        for nag in NAG_NAMES:
+            self.nags[nag] += player_stats[nag]
+        self.total_accuracy += player_stats['total_accuracy']
+        self.accuracy_count += player_stats['accuracy_count']
+        if player_stats.get('game_accuracy') is not None:
+            self.game_accuracy.add(player_stats['game_accuracy'])
+    
+    def row(self):
+        """Summary of the totals (see AGGREGATE_FIELDS); accuracies are None when unknown."""
+        errors = sum(self.nags.values())
+        row = {
+            'games': self.games,
+            'moves': self.moves,
+            'inaccuracies': self.nags[6],
+            'mistakes': self.nags[2],
+            'blunders': self.nags[4],
+            'error_rate': errors / self.moves * 100 if self.moves else 0.0,
+            'move_accuracy': self.total_accuracy / self.accuracy_count if self.accuracy_count else None,
+            'game_accuracy': self.game_accuracy.mean(),
+        }
+        for p in AGGREGATE_PERCENTILES:
+            row[f'game_accuracy_p{p}'] = self.game_accuracy.percentile(p)
+        return row
+
+AGGREGATE_GROUPS = ['colour', 'player', 'event']
+AGGREGATE_FIELDS = (['group', 'name', 'games', 'moves', 'inaccuracies', 'mistakes', 'blunders', 'error_rate',
+                     'move_accuracy', 'game_accuracy'] + [f'game_accuracy_p{p}' for p in AGGREGATE_PERCENTILES])
+
+class AggregateReport:
+    """Cross-game summary per colour, player and event, fed one game's stats at a time.
+    
+    Only running totals and fixed-size sketches are kept, one per distinct
+    name: memory grows with the number of players and events, not of games.
+    """
+    
+    def __init__(self):
+        self.groups = {group: {} for group in AGGREGATE_GROUPS}
+        self.games = 0
+    
+    def totals(self, group, name):
+        if name not in self.groups[group]:
+            self.groups[group][name] = RunningTotals()
+        return self.groups[group][name]
+    
+    def add(self, stats):
+        headers = stats['plies']['headers']
+        self.games += 1
+        event = headers.get('Event', '?')
+        for side, player in [('white', 'White'), ('black', 'Black')]:
+            self.totals('colour', player).add(stats[side])
+            self.totals('player', headers.get(player, '?')).add(stats[side])
+            self.totals('event', event).add(stats[side], games=1 if side == 'white' else 0)
+    
+    def rows(self):
+        """Rows of every group; players and events sorted by number of games, then name."""
+        for group in AGGREGATE_GROUPS:
+            names = self.groups[group]
+            order = list(names) if group == 'colour' else sorted(names, key=lambda name: (-names[name].games, name))
+            for name in order:
+                yield dict(names[name].row(), group=group, name=name)
+    
+    def write_csv(self, handle):
+        writer = csv.DictWriter(handle, AGGREGATE_FIELDS)
+        writer.writeheader()
+        for row in self.rows():
+            writer.writerow({field: f"{value:.2f}" if isinstance(value, float) else value
+                             for field, value in row.items()})
+    
+    def generate(self):
+        """Text summary of every group."""
+        def accuracy(value):
+            return f"{value:.1f}%" if value is not None else "N/A"
+        
+        report_lines = []
+        report_lines.append("=" * 60)
+        report_lines.append("AGGREGATE ANALYSIS REPORT")
+        report_lines.append("=" * 60)
+        report_lines.append("")
+        report_lines.append(f"Games: {self.games}")
+        report_lines.append(f"Game accuracy percentiles: "
+                            f"{', '.join(f'p{p}' for p in AGGREGATE_PERCENTILES)} "
+                            f"(within {SKETCH_RESOLUTION / 2} points)")
+        
+        titles = {'colour': "BY COLOUR:", 'player': "BY PLAYER:", 'event': "BY EVENT:"}
+        current = None
+        for row in self.rows():
+            if row['group'] != current:
+                current = row['group']
+                report_lines.append("")
+                report_lines.append(titles[current])
+            percentiles = " / ".join(accuracy(row[f'game_accuracy_p{p}']) for p in AGGREGATE_PERCENTILES)
+            report_lines.append(f"{row['name']}: {row['games']} game{'s' if row['games'] != 1 else ''}, "
+                                f"{row['moves']} moves")
+            report_lines.append(f"  Errors: {row['inaccuracies']} ?!, {row['mistakes']} ?, {row['blunders']} ?? "
+                                f"(error rate {row['error_rate']:.1f}%)")
+            report_lines.append(f"  Average Move Accuracy: {accuracy(row['move_accuracy'])}")
+            report_lines.append(f"  Game Accuracy: {accuracy(row['game_accuracy'])} on average ({percentiles})")
+        return "\n".join(report_lines)
+
+def aggregate_csv_path(path):
+    """CSV written next to an aggregate report."""
+    return os.path.splitext(path)[0] + ".csv"
+
+def write_aggregate(aggregate, path):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(aggregate.generate())
+    with open(aggregate_csv_path(path), "w", encoding="utf-8", newline="") as f:
+        aggregate.write_csv(f)
+
+# ---------------- CHECKPOINT ----------------
+
+class Checkpoint:
+    """Crash-safe progress of a run, for --resume.
+    
+    The checkpoint file gets one JSON line per finished game, written once its
+    outputs are flushed; games finish in input order, so the last line says
+    where to resume (input offset, output size and running totals). Positions
+    analysed for games still in progress are logged in <checkpoint>.d/.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.plies_dir = path + ".d"
+    
+    def plies_path(self, index):
+        return os.path.join(self.plies_dir, f"game_{index}.jsonl")
+    
+    def last_done(self):
+        """The last complete 'game done' record, or None."""
+        last = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        last = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write from a crash
+        except FileNotFoundError:
+            pass
+        return last
+    
+    def stored_plies(self, index):
+        """Analyses logged for a game in progress, as {ply: analysis}, or None."""
+        stored = {}
+        try:
+            with open(self.plies_path(index), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    stored[entry['ply']] = decode_analysis(entry['analysis'])
+        except FileNotFoundError:
+            pass
+        return stored or None
+    
+    def start(self, resume):
+        """Prepare the checkpoint; a fresh run discards any previous one."""
+        if not resume:
+            self.remove()
+        os.makedirs(self.plies_dir, exist_ok=True)
+    
+    def record_done(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.remove(self.plies_path(record['games'] - 1))
+        except FileNotFoundError:
+            pass
+    
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if os.path.isdir(self.plies_dir):
+            for name in os.listdir(self.plies_dir):
+                os.remove(os.path.join(self.plies_dir, name))
+            os.rmdir(self.plies_dir)
+
+# ---------------- WATCH ----------------
+
+class WarmWorkers:
+    """Workers set up once (see _init_worker) and reused for every job of a daemon.
+    
+    Engines, cache connection, book and tablebase stay open between jobs, so
+    a job only pays for its searches. With a single worker everything runs
+    in this process.
+    """
+    
+    def __init__(self, workers, options):
+        self.pool = None
+        if workers <= 1:
+            _open_worker(options)
+        else:
+            self.pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(options,))
+    
+    def imap(self, func, items):
+        """Yield func(item) for every item, in order."""
+        if self.pool is None:
+            return map(func, items)
+        return self.pool.imap(func, items)
+    
+    def close(self):
+        """Shut the workers down; safe to call again, and with crashed engines."""
+        if self.pool is None:
+            _close_worker()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def inbox_ready(inbox, sizes):
+    """PGN files of the inbox whose size did not change since the last poll.
+    
+    sizes maps paths to the size seen at the previous poll and is updated;
+    files still being written are left for a later poll.
+    """
+    ready = []
+    seen = {}
+    for entry in sorted(os.scandir(inbox), key=lambda entry: entry.name):
+        if entry.name.startswith(".") or not entry.name.endswith(".pgn") or not entry.is_file():
+            continue
+        size = entry.stat().st_size
+        if size > 0 and sizes.get(entry.path) == size:
+            ready.append(entry.path)
+        else:
+            seen[entry.path] = size
+    sizes.clear()
+    sizes.update(seen)
+    return ready
+
+def annotate_inbox_file(path, workers, outbox, variations=False, budget=None):
+    """Annotate the games of one inbox file into the outbox.
+    
+    Writes <name>.pgn, its evals and the reports (<name>_report.txt, numbered
+    for multi-game files). The annotated PGN is renamed into place last, so
+    its presence means the job is complete. Returns (games, errors found).
+    
+    A file with a game that does not parse or has no moves (e.g. a file that
+    is not PGN at all, read as one empty game) raises ValueError.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    read_game = read_tree_game if variations else read_mainline_game
+    pgn_texts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            game = read_game(f)
+            if game is None:
+                break
+            if game.errors:
+                raise ValueError(f"Game {len(pgn_texts) + 1} of {path} does not parse: {game.errors[0]}")
+            if not game.variations:
+                raise ValueError(f"Game {len(pgn_texts) + 1} of {path} has no moves")
+            pgn_texts.append(str(game))
+    if not pgn_texts:
+        raise ValueError(f"Could not read game from {path}")
+    multi_game = len(pgn_texts) > 1
+    output = os.path.join(outbox, name + ".pgn")
+    report = os.path.join(outbox, name + "_report.txt")
+    
+    errors = 0
+    jobs = [(index, pgn_text, None, budget) for index, pgn_text in enumerate(pgn_texts)]
+    try:
+        with open(output + ".part", "w", encoding="utf-8") as pgn_out, \
+                open(output + EVALS_SUFFIX, "w", encoding="utf-8") as evals_out:
+            for index, (annotated_pgn, report_text, stats) in enumerate(workers.imap(_analyse_in_worker, jobs), 1):
+                with open(report_path(report, index, multi_game), "w", encoding="utf-8") as f:
+                    f.write(report_text)
+                print(annotated_pgn, file=pgn_out, end="\n\n")
+                write_evals(evals_out, index, stats)
+                errors += sum(stats['white'][nag] + stats['black'][nag] for nag in [6, 2, 4])
+    except BaseException:
+        # Leave no half-written output of a failed job in the outbox
+        for leftover in (output + ".part", output + EVALS_SUFFIX):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    os.replace(output + ".part", output)
+    return len(pgn_texts), errors
+
+# ---------------- DISTRIBUTED ----------------
+
+def parse_address(address, listen=False):
+    """Socket family and address of "host:port" (TCP) or a filesystem path (Unix socket).
+    
+    An empty host means all interfaces when listening, this host otherwise.
+    """
+    host, _, port = address.rpartition(":")
+    if "/" in address or not port.isdigit():
+        return socket.AF_UNIX, address
+    return socket.AF_INET, (host or ("0.0.0.0" if listen else "localhost"), int(port))
+
+class JobQueue:
+    """Games of a batch handed out to workers, with heartbeat-based re-queueing.
+    
+    A job is pending, running (with the time of its last sign of life) or
+    finished. A running job whose worker disconnects or makes no search
+    progress for HEARTBEAT_TIMEOUT goes back to the front of the queue, keeping the plies
+    already streamed back so the next worker does not search them again.
+    Results are handed over in input order (see wait_result).
+    """
+    
+    def __init__(self, pgn_texts, settings):
+        self.pgn_texts = pgn_texts
+        self.settings = settings  # sent with every job (see run_worker)
+        self.changed = threading.Condition()
+        self.pending = collections.deque(range(len(pgn_texts)))
+        self.running = {}  # job -> [worker, time of the last sign of life]
+        self.stored = [{} for _ in pgn_texts]  # job -> ply -> encoded analysis
+        self.results = {}  # job -> (encoded analyses, extra stats), until handed over
+        self.finished = set()
+        self.workers = 0  # connected
+        self.requeued = 0
+    
+    def connect(self):
+        with self.changed:
+            self.workers += 1
+    
+    def take(self, worker):
+        """The next job for worker, or a 'wait' or 'done' message."""
+        with self.changed:
+            self._requeue_stale()
+            if self.pending:
+                job = self.pending.popleft()
+                self.running[job] = [worker, time.monotonic()]
+                return dict(self.settings, type='job', job=job, pgn=self.pgn_texts[job], stored=self.stored[job])
+            if len(self.finished) == len(self.pgn_texts):
+                return {'type': 'done'}
+            return {'type': 'wait'}
+    
+    def heartbeat(self, worker, job):
+        with self.changed:
+            if job in self.running and self.running[job][0] == worker:
+                self.running[job][1] = time.monotonic()
+    
+    def record(self, worker, job, ply, analysis):
+        with self.changed:
+            if job not in self.finished:
+                self.stored[job][str(ply)] = analysis
+        self.heartbeat(worker, job)
+    
+    def complete(self, worker, job, result):
+        """Store the result of a job; a late duplicate from a worker given up on is ignored."""
+        with self.changed:
+            if job in self.finished:
+                return
+            self.finished.add(job)
+            self.results[job] = result
+            self.running.pop(job, None)
+            if job in self.pending:
+                self.pending.remove(job)
+            self.stored[job] = {}
+            self.changed.notify_all()
+    
+    def release(self, worker):
+        """Re-queue the jobs of a worker that disconnected."""
+        with self.changed:
+            self.workers -= 1
+            for job, (owner, _) in list(self.running.items()):
+                if owner == worker:
+                    self._requeue(job)
+            self.changed.notify_all()
+    
+    def _requeue_stale(self):
+        now = time.monotonic()
+        for job, (_, seen) in list(self.running.items()):
+            if now - seen > HEARTBEAT_TIMEOUT:
+                self._requeue(job)
+    
+    def _requeue(self, job):
+        del self.running[job]
+        self.pending.appendleft(job)
+        self.requeued += 1
+        print(f"Game {job + 1}: worker lost, job re-queued")
+    
+    def wait_result(self, job):
+        """Block until job is finished and return its encoded analyses and extra stats."""
+        with self.changed:
+            while job not in self.results:
+                self.changed.wait(HEARTBEAT_INTERVAL)
+                self._requeue_stale()
+            return self.results.pop(job)
+    
+    def wait_workers_gone(self, timeout):
+        """Give connected workers up to timeout seconds to fetch their 'done' message."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.workers > 0 and time.monotonic() < deadline:
+                self.changed.wait(deadline - time.monotonic())
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    """One worker connection: JSON lines in, a reply to each 'get'."""
+    
+    def handle(self):
+        queue = self.server.queue
+        worker = f"{self.client_address or 'local'}#{next(self.server.worker_ids)}"
+        queue.connect()
+        print(f"Worker connected: {worker}")
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message['type'] == 'get':
+                    self.wfile.write((json.dumps(queue.take(worker)) + "\n").encode())
+                elif message['type'] == 'heartbeat':
+                    queue.heartbeat(worker, message['job'])
+                elif message['type'] == 'ply':
+                    queue.record(worker, message['job'], message['ply'], message['analysis'])
+                elif message['type'] == 'result':
+                    queue.complete(worker, message['job'], (message['analyses'], message['stats']))
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            queue.release(worker)
+            print(f"Worker disconnected: {worker}")
+
+def serve_jobs(address, queue):
+    """Start serving queue at address in a background thread; returns the server."""
+    family, target = parse_address(address, listen=True)
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            os.remove(target)  # left over from an earlier coordinator
+        server_class = socketserver.ThreadingUnixStreamServer
+    else:
+        server_class = socketserver.ThreadingTCPServer
+        server_class.allow_reuse_address = True
+    server = server_class(target, _CoordinatorHandler)
+    server.daemon_threads = True
+    server.queue = queue
+    server.worker_ids = itertools.count(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_worker(address, options):
+    """Analyse jobs from the coordinator at address with a local engine until it is done.
+    
+    Every analysed position is streamed back as soon as it is searched, and a
+    heartbeat is sent every HEARTBEAT_INTERVAL in which an engine search
+    finished, so a hung engine goes silent and the coordinator re-queues its job.
+    The coordinator's annotation settings, adaptive mode and budget apply.
+    """
+    family, target = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(target)
+    rfile = sock.makefile('r', encoding='utf-8')
+    wfile = sock.makefile('w', encoding='utf-8')
+    send_lock = threading.Lock()
+    
+    def send(message):
+        with send_lock:
+            wfile.write(json.dumps(message) + "\n")
+            wfile.flush()
+    
+    _open_worker(options)
+    jobs = 0
+    try:
+        while True:
+            send({'type': 'get'})
+            line = rfile.readline()
+            if not line:
+                print("Coordinator closed the connection")
+                break
+            reply = json.loads(line)
+            if reply['type'] == 'done':
+                break
+            if reply['type'] == 'wait':
+                time.sleep(WORKER_POLL)
+                continue
+            
+            job = reply['job']
+            configure_annotation(**reply['annotation'])
+            stored = {int(ply): decode_analysis(data) for ply, data in reply['stored'].items()}
+            budget = SearchBudget(*reply['budget']) if reply['budget'] is not None else None
+            stop = threading.Event()
+            
+            def heartbeat():
+                seen = searches_finished
+                while not stop.wait(HEARTBEAT_INTERVAL):
+                    if searches_finished != seen:
+                        seen = searches_finished
+                        send({'type': 'heartbeat', 'job': job})
+            
+            def record(ply, analysis):
+                send({'type': 'ply', 'job': job, 'ply': ply, 'analysis': encode_analysis(analysis)})
+            
+            beating = threading.Thread(target=heartbeat, daemon=True)
+            beating.start()
+            try:
+                start = time.perf_counter()
+                game = read_mainline_game(io.StringIO(reply['pgn']))
+                parse_time = time.perf_counter() - start
+                start = time.perf_counter()
+                _, stats, _ = annotate_game(game, _worker_engine, _worker_cache, _worker_book, reply['adaptive'],
+                                            stored or None, record, budget, _worker_tablebase)
+                stats['timing'] = {'parse': parse_time, 'analysis': time.perf_counter() - start}
+            finally:
+                stop.set()
+                beating.join()
+            # What annotate_from_analyses cannot rebuild from the analyses alone
+            extra = {name: stats[name] for name in ('alternatives', 'cache', 'budget', 'timing') if name in stats}
+            send({'type': 'result', 'job': job, 'analyses': [encode_analysis(a) for a in stats['analyses']],
+                  'stats': extra})
+            jobs += 1
+    finally:
+        _close_worker()
+        sock.close()
+    print(f"Worker finished: {jobs} games analysed")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Annotate chess games with Stockfish (negative annotations only).")
+    parser.add_argument("input", nargs="?", default=PGN_INPUT, help=f"PGN file to analyse (default: {PGN_INPUT})")
+    parser.add_argument("-o", "--output", default=PGN_OUTPUT, help=f"annotated PGN output (default: {PGN_OUTPUT})")
+    parser.add_argument("-r", "--report", default=REPORT_OUTPUT,
+                        help=f"report output; numbered per game for multi-game files (default: {REPORT_OUTPUT})")
+    parser.add_argument("-j", "--workers", type=int, default=WORKERS,
+                        help=f"worker processes, each with its own Stockfish (default: {WORKERS})")
+    parser.add_argument("-k", "--engines", type=int, default=GAME_ENGINES,
+                        help=f"engines per worker sharing the positions of each game (default: {GAME_ENGINES})")
+    parser.add_argument("--cache", default=CACHE_PATH, help=f"evaluation cache file (default: {CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the evaluation cache")
+    parser.add_argument("--book", default=BOOK_PATH,
+                        help="Polyglot opening book (.bin): book moves are not searched nor annotated")
+    parser.add_argument("--syzygy", default=SYZYGY_PATH,
+                        help=f"Syzygy tablebase directory: positions with up to {SYZYGY_MAX_PIECES} pieces "
+                             f"are probed instead of searched")
+    parser.add_argument("--adaptive", action="store_true", default=ADAPTIVE,
+                        help=f"search at depth {SHALLOW_DEPTH} first, then at depth {DEPTH} only near annotation thresholds")
+    parser.add_argument("--variations", action="store_true", default=VARIATIONS,
+                        help="keep and annotate the side variations of the input, searching each position "
+                             "off the main line once (the report, evals and export cover the main line)")
+    parser.add_argument("--hash", type=int, default=ENGINE_HASH,
+                        help=f"Stockfish hash table size per engine in MB (default: {ENGINE_HASH})")
+    parser.add_argument("--order", choices=["input", "opening"], default=ORDER,
+                        help="analyse games in input order, or grouped by shared opening moves so the engine "
+                             "hash table stays warm (holds the whole batch in memory); output keeps input order "
+                             f"(default: {ORDER})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="search positions shared between games (e.g. openings) only once per batch "
+                             "(holds the whole batch in memory)")
+    parser.add_argument("--metrics",
+                        help="write per-call engine metrics to this file (.csv for CSV, otherwise JSON lines)")
+    parser.add_argument("--export",
+                        help="also write every analysed ply to this directory as memory-mappable columns "
+                             "(see read_ply_export)")
+    parser.add_argument("--aggregate", metavar="REPORT",
+                        help="also write a summary of all games per colour, player and event to REPORT, and as "
+                             "CSV next to it (.csv)")
+    parser.add_argument("--watch", metavar="INBOX",
+                        help="run as a daemon: annotate every PGN file dropped into this directory, keeping the "
+                             "engines running between files (input, -o and -r are not used)")
+    parser.add_argument("--outbox", default=WATCH_OUTBOX,
+                        help=f"with --watch, directory for the annotated PGN, reports and evals "
+                             f"(default: {WATCH_OUTBOX})")
+    parser.add_argument("--coordinator", metavar="ADDRESS",
+                        help="serve the games of the input as jobs at ADDRESS (host:port or a Unix socket path) "
+                             "and write the outputs from the analyses workers send back")
+    parser.add_argument("--worker", metavar="ADDRESS",
+                        help="analyse jobs from the coordinator at ADDRESS with the local engine (input, -o and "
+                             "-r are not used)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its checkpoint (<output>.checkpoint)")
+    parser.add_argument("--time-budget", type=float,
+                        help=f"engine seconds to spend per game (or per batch, see --budget-scope) instead of "
+                             f"searching every position to depth {DEPTH}")
+    parser.add_argument("--node-budget", type=int, help="like --time-budget, as a number of nodes")
+    parser.add_argument("--budget-scope", choices=["game", "batch"], default="game",
+                        help="budget per game, or for the whole input split by game length (default: game)")
+    parser.add_argument("--reannotate", action="store_true",
+                        help=f"recompute annotations and reports from the evaluations saved by a previous run "
+                             f"(<input>{EVALS_SUFFIX}), without the engine")
+    parser.add_argument("--evals", help=f"evaluations file for --reannotate (default: <input>{EVALS_SUFFIX})")
+    parser.add_argument("--depth", type=int, default=DEPTH,
+                        help=f"with --reannotate, refuse evaluations searched shallower than this (default: {DEPTH})")
+    parser.add_argument("--inaccuracy", type=float, help=f"inaccuracy threshold in pawns (default: {THRESH_INACCURACY})")
+    parser.add_argument("--mistake", type=float, help=f"mistake threshold in pawns (default: {THRESH_MISTAKE})")
+    parser.add_argument("--blunder", type=float, help=f"blunder threshold in pawns (default: {THRESH_BLUNDER})")
+    parser.add_argument("--skip-moves", type=int,
+                        help=f"first moves of each side never annotated (default: {SKIP_MOVES})")
+    return parser.parse_args()
+
 # ---------------- MAIN ----------------
 
+def reannotate(args):
+    """Annotate and report the games of args.input again from their stored evaluations.
+    
+    No engine is started. Games and evaluations are read side by side, one
+    game at a time, so memory does not grow with the number of games. The
+    PGN and evals are written to .part files renamed into place at the end,
+    so the output may be the input itself; at the first game whose
+    evaluations do not match it or were searched shallower than args.depth
+    nothing is replaced.
+    """
+    evals_file = args.evals or args.input + EVALS_SUFFIX
+    print(f"Reading PGN file: {args.input}")
+    first_games = list(itertools.islice(iter_games(args.input), 2))
+    if not first_games:
+        print(f"Error: Could not read game from {args.input}")
+        return
+    multi_game = len(first_games) > 1
+    print(f"Reading stored evaluations: {evals_file}")
+    
+    index = 0
+    total_moves, total_errors = 0, 0
+    export = PlyExport(args.export) if args.export else None
+    aggregate = AggregateReport() if args.aggregate else None
+    outputs = [args.output, args.output + EVALS_SUFFIX]
+    complete = False
+    try:
+        with open(outputs[0] + ".part", "w", encoding="utf-8") as pgn_out, \
+                open(outputs[1] + ".part", "w", encoding="utf-8") as evals_out:
+            pairs = itertools.zip_longest(iter_games(args.input), iter_evals(evals_file))
+            for index, (entry, record) in enumerate(pairs, 1):
+                if record is None:
+                    print(f"Error: {evals_file} has evaluations for {index - 1} games, {args.input} has more")
+                    return
+                if entry is None:
+                    print(f"Error: {evals_file} has evaluations for more games than the {index - 1} of {args.input}")
+                    return
+                if record['depth'] < args.depth:
+                    print(f"Error: cannot re-annotate: the evaluations of game {index} were searched at depth "
+                          f"{record['depth']}, lower than the requested depth {args.depth}. "
+                          f"Run the engine again, or pass --depth {record['depth']}.")
+                    return
+                game = read_mainline_game(io.StringIO(entry[0]))
+                plies = sum(1 for _ in game.mainline_moves())
+                if plies != record['plies']:
+                    print(f"Error: game {index} has {plies} plies but its stored evaluations cover {record['plies']}")
+                    return
+                
+                annotated_game, stats, annotated_moves = annotate_from_analyses(game, record['analyses'])
+                stats['reannotated'] = {'path': evals_file, 'depth': record['depth']}
+                with open(report_path(args.report, index, multi_game), "w", encoding="utf-8") as f:
+                    f.write(generate_report(annotated_game, stats, annotated_moves))
+                print(annotated_game, file=pgn_out, end="\n\n")
+                write_evals(evals_out, index, stats)
+                if export is not None:
+                    export.append(index, stats)
+                if aggregate is not None:
+                    aggregate.add(stats)
+                
+                total_moves += stats['total_moves']
+                total_errors += sum(stats['white'][nag] + stats['black'][nag] for nag in [6, 2, 4])
+        complete = True
+    finally:
+        if export is not None:
+            export.close()
+        for output in outputs:
+            if complete:
+                os.replace(output + ".part", output)
+            elif os.path.exists(output + ".part"):
+                os.remove(output + ".part")
+    if aggregate is not None:
+        write_aggregate(aggregate, args.aggregate)
+    
+    print(f"\nRe-annotation complete!")
+    print(f"- Annotated PGN saved to: {args.output}")
+    if aggregate is not None:
+        print(f"- Aggregate report saved to: {args.aggregate} ({aggregate_csv_path(args.aggregate)})")
+    print(f"- Games re-annotated: {index}")
+    print(f"- Total moves analyzed: {total_moves}")
+    print(f"- Total errors found: {total_errors}")
+
+def coordinate(args, budget=None):
+    """Serve the games of args.input to workers and assemble their results.
+    
+    Outputs are the same as those of a local run and are written in input
+    order, from the analyses alone, so they do not depend on which worker
+    analysed which game or in which order the results arrived.
+    """
+    print(f"Reading PGN file: {args.input}")
+    pgn_texts = [pgn_text for pgn_text, _ in iter_games(args.input)]
+    if not pgn_texts:
+        print(f"Error: Could not read game from {args.input}")
+        return
+    multi_game = len(pgn_texts) > 1
+    
+    settings = {'annotation': {'inaccuracy': THRESH_INACCURACY, 'mistake': THRESH_MISTAKE,
+                               'blunder': THRESH_BLUNDER, 'skip_moves': SKIP_MOVES},
+                'adaptive': args.adaptive, 'budget': budget}
+    queue = JobQueue(pgn_texts, settings)
+    server = serve_jobs(args.coordinator, queue)
+    print(f"Serving {len(pgn_texts)} games at {args.coordinator}; start workers with --worker {args.coordinator}")
+    
+    total_moves, total_errors = 0, 0
+    metrics_out = open(args.metrics, "w", encoding="utf-8", newline="") if args.metrics else None
+    export = PlyExport(args.export) if args.export else None
+    aggregate = AggregateReport() if args.aggregate else None
+    try:
+        with open(args.output, "w", encoding="utf-8") as pgn_out, \
+                open(args.output + EVALS_SUFFIX, "w", encoding="utf-8") as evals_out:
+            for job, pgn_text in enumerate(pgn_texts):
+                encoded, extra = queue.wait_result(job)
+                analyses = [decode_analysis(data) for data in encoded]
+                index = job + 1
+                game = read_mainline_game(io.StringIO(pgn_text))
+                annotated_game, stats, annotated_moves = annotate_from_analyses(game, analyses)
+                stats.update(extra)
+                if args.adaptive:
+                    stats['adaptive'] = adaptive_stats(analyses)
+                start = time.perf_counter()
+                report = generate_report(annotated_game, stats, annotated_moves)
+                stats['timing']['report'] = time.perf_counter() - start
+                with open(report_path(args.report, index, multi_game), "w", encoding="utf-8") as f:
+                    f.write(report)
+                print(annotated_game, file=pgn_out, end="\n\n")
+                pgn_out.flush()
+                write_evals(evals_out, index, stats)
+                if export is not None:
+                    export.append(index, stats)
+                if metrics_out is not None:
+                    write_metrics(metrics_out, index, stats, args.metrics.endswith(".csv"))
+                if aggregate is not None:
+                    aggregate.add(stats)
+                total_moves += stats['total_moves']
+                total_errors += sum(stats['white'][nag] + stats['black'][nag] for nag in [6, 2, 4])
+                print(f"Game {index} of {len(pgn_texts)} done")
+        if aggregate is not None:
+            write_aggregate(aggregate, args.aggregate)
+        queue.wait_workers_gone(2 * WORKER_POLL)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if export is not None:
+            export.close()
+        if metrics_out is not None:
+            metrics_out.close()
+    
+    print(f"\nAnalysis complete!")
+    print(f"- Annotated PGN saved to: {args.output}")
+    if aggregate is not None:
+        print(f"- Aggregate report saved to: {args.aggregate} ({aggregate_csv_path(args.aggregate)})")
+    print(f"- Games analyzed: {len(pgn_texts)} ({queue.requeued} jobs re-queued after a lost worker)")
+    print(f"- Total moves analyzed: {total_moves}")
+    print(f"- Total errors found: {total_errors}")
+
+def _stop_watching(signum, frame):
+    raise KeyboardInterrupt
+
+def watch(args, options, budget=None):
+    """Annotate every PGN file dropped into args.watch, until interrupted (Ctrl-C or SIGTERM).
+    
+    Done input files are moved to <inbox>/processed, failed ones to
+    <inbox>/failed (with the error in <name>.error.txt). After a failure the
+    workers are restarted, so a crashed engine does not stop the daemon.
+    """
+    processed = os.path.join(args.watch, "processed")
+    failed = os.path.join(args.watch, "failed")
+    for directory in (args.outbox, processed, failed):
+        os.makedirs(directory, exist_ok=True)
+    
+    signal.signal(signal.SIGTERM, _stop_watching)
+    print("Starting Stockfish...")
+    workers = WarmWorkers(args.workers, options)
+    print(f"Watching {args.watch} for PGN files (results in {args.outbox}); press Ctrl-C to stop")
+    sizes = {}
+    try:
+        while True:
+            for path in inbox_ready(args.watch, sizes):
+                name = os.path.basename(path)
+                start = time.perf_counter()
+                try:
+                    games, errors = annotate_inbox_file(path, workers, args.outbox, options['variations'], budget)
+                except Exception as e:
+                    print(f"Error: {name}: {e}")
+                    with open(os.path.join(failed, name + ".error.txt"), "w", encoding="utf-8") as f:
+                        f.write(f"{e}\n")
+                    os.replace(path, os.path.join(failed, name))
+                    workers.close()
+                    workers = WarmWorkers(args.workers, options)
+                    continue
+                os.replace(path, os.path.join(processed, name))
+                print(f"{name}: {games} game(s), {errors} errors found in {time.perf_counter() - start:.2f}s")
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        workers.close()
+
 def main():
+    args = parse_args()
+    annotation = {'inaccuracy': args.inaccuracy, 'mistake': args.mistake, 'blunder': args.blunder,
+                  'skip_moves': args.skip_moves}
+    configure_annotation(**annotation)
+    if args.reannotate:
+        try:
+            reannotate(args)
+        except FileNotFoundError as e:
+            print(f"Error: File not found - {e}")
+        return
+    
+    if args.time_budget is not None and args.node_budget is not None:
+        print("Error: give either --time-budget or --node-budget, not both")
+        return
+    budget_kind = 'time' if args.time_budget is not None else 'nodes' if args.node_budget is not None else None
+    if budget_kind is not None and (args.adaptive or args.dedup):
+        print("Error: a budget cannot be combined with --adaptive or --dedup")
+        return
+    if args.order == 'opening' and args.dedup:
+        print("Error: --order opening cannot be combined with --dedup")
+        return
+    if args.variations and (args.dedup or budget_kind is not None):
+        print("Error: --variations cannot be combined with --dedup or a budget")
+        return
+    if args.aggregate and (args.resume or args.watch or args.worker):
+        print("Error: --aggregate cannot be combined with --resume, --watch or --worker "
+              "(run --reannotate --aggregate on the finished output instead)")
+        return
+    
+    if args.coordinator or args.worker:
+        if args.resume or args.dedup or args.order != 'input' or args.variations or args.watch or \
+                (budget_kind is not None and args.budget_scope == 'batch'):
+            print("Error: --coordinator and --worker cannot be combined with --resume, --dedup, --order, "
+                  "--variations, --watch or a batch budget")
+            return
+        budget_total = args.time_budget if budget_kind == 'time' else args.node_budget
+        try:
+            if args.coordinator:
+                coordinate(args, (budget_kind, budget_total) if budget_kind is not None else None)
+            else:
+                run_worker(args.worker, analysis_options(None if args.no_cache else args.cache, args.book,
+                                                         args.adaptive, args.engines, None, annotation,
+                                                         args.syzygy, args.hash))
+        except (FileNotFoundError, ConnectionError) as e:
+            print(f"Error: {e}")
+        return
+    
+    if args.watch:
+        if args.resume or args.dedup or args.order != 'input' or args.metrics or args.export or \
+                (budget_kind is not None and args.budget_scope == 'batch'):
+            print("Error: --watch cannot be combined with --resume, --dedup, --order, --metrics, --export "
+                  "or a batch budget")
+            return
+        options = analysis_options(None if args.no_cache else args.cache, args.book, args.adaptive, args.engines,
+                                   None, annotation, args.syzygy, args.hash, args.variations)
+        budget_total = args.time_budget if budget_kind == 'time' else args.node_budget
+        watch(args, options, (budget_kind, budget_total) if budget_kind is not None else None)
+        return
+    
+    checkpoint = Checkpoint(args.output + ".checkpoint")
+    metrics_out = None
+    evals_out = None
+    export = None
+    aggregate = AggregateReport() if args.aggregate else None
     try:
-        print(f"Reading PGN file: {PGN_INPUT}")
-        with open(PGN_INPUT, 'r', encoding='utf-8') as f:
-            game = chess.pgn.read_game(f)
+        print(f"Reading PGN file: {args.input}")
+        first_games = [pgn_text for pgn_text, _ in itertools.islice(iter_games(args.input, 0, args.variations), 2)]
         
-        if game is None:
-            print(f"Error: Could not read game from {PGN_INPUT}")
+        if not first_games:
+            print(f"Error: Could not read game from {args.input}")
             return
+        multi_game = len(first_games) > 1
         
-        print(f"Game loaded: {game.headers.get('White', '?')} vs {game.headers.get('Black', '?')}")
+        # Pick up after the last finished game of an interrupted run
+        done = checkpoint.last_done() if args.resume else None
+        if done is not None:
+            print(f"Resuming after {done['games']} finished games")
+            start_index, offset = done['games'], done['next_offset']
+            total_moves, total_errors = done['total_moves'], done['total_errors']
+            budget_spent = done.get('budget_spent', 0)
+            pgn_out = open(args.output, "r+", encoding="utf-8")
+            pgn_out.truncate(done['pgn_end'])
+            pgn_out.seek(done['pgn_end'])
+            evals_out = open(args.output + EVALS_SUFFIX, "r+", encoding="utf-8")
+            evals_out.truncate(done.get('evals_end', 0))
+            evals_out.seek(done.get('evals_end', 0))
+            if args.metrics:
+                metrics_out = open(args.metrics, "r+", encoding="utf-8", newline="")
+                metrics_out.truncate(done.get('metrics_end', 0))
+                metrics_out.seek(done.get('metrics_end', 0))
+        else:
+            if args.resume:
+                print("No checkpoint found, starting from the first game")
+            start_index, offset = 0, 0
+            total_moves, total_errors = 0, 0
+            budget_spent = 0
+            pgn_out = open(args.output, "w", encoding="utf-8")
+            evals_out = open(args.output + EVALS_SUFFIX, "w", encoding="utf-8")
+            if args.metrics:
+                metrics_out = open(args.metrics, "w", encoding="utf-8", newline="")
+        if args.export:
+            export = PlyExport(args.export, keep_games=done['games'] if done is not None else 0)
+        checkpoint.start(resume=args.resume)
         
-        # Clean all existing annotations
-        game = clean_game_annotations(game)
+        budget_total = args.time_budget if budget_kind == 'time' else args.node_budget
+        if budget_kind is not None and args.budget_scope == 'batch':
+            budgets = [(budget_kind, total) for total in game_budgets(args.input, budget_total)]
+        else:
+            budgets = None
         
         print("Starting Stockfish analysis...")
         
-        # Annotate game with Stockfish
-        with chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH) as engine:
-            annotated_game, stats, annotated_moves = annotate_game(game, engine)
+        next_offsets = collections.deque()
         
-        # Generate report
-        print("Generating analysis report...")
-        report = generate_report(annotated_game, stats, annotated_moves)
+        def jobs():
+            games = iter_games(args.input, offset, args.variations)
+            for index, (pgn_text, next_offset) in enumerate(games, start_index):
+                next_offsets.append(next_offset)
+                if budgets is not None:
+                    budget = budgets[index]
+                else:
+                    budget = (budget_kind, budget_total) if budget_kind is not None else None
+                yield index, pgn_text, checkpoint.stored_plies(index), budget
         
-        # Write the report
-        with open(REPORT_OUTPUT, "w", encoding="utf-8") as f:
-            f.write(report)
+        index = start_index
+        with pgn_out:
+            options = analysis_options(None if args.no_cache else args.cache, args.book, args.adaptive, args.engines,
+                                       checkpoint.path, annotation, args.syzygy, args.hash, args.variations)
+            if args.dedup:
+                pgn_texts = [pgn_text for _, pgn_text, _, _ in jobs()]
+                results = analyse_games_dedup(pgn_texts, args.workers, options)
+            elif args.order == 'opening':
+                job_list = list(jobs())
+                prefixes = [opening_prefix(pgn_text) for _, pgn_text, _, _ in job_list]
+                order = opening_order(prefixes)
+                print(f"Opening order: {shared_plies(prefixes, order)} plies shared with the previous game "
+                      f"({shared_plies(prefixes, list(range(len(prefixes))))} in input order)")
+                results = analyse_games_ordered(job_list, order, args.workers, options)
+            else:
+                results = analyse_games(jobs(), args.workers, options)
+            for annotated_pgn, report, stats in results:
+                index += 1
+                
+                # Write the report
+                with open(report_path(args.report, index, multi_game), "w", encoding="utf-8") as f:
+                    f.write(report)
+                
+                # Write the clean annotated game
+                print(annotated_pgn, file=pgn_out, end="\n\n")
+                pgn_out.flush()
+                os.fsync(pgn_out.fileno())
+                
+                write_evals(evals_out, index, stats)
+                if export is not None:
+                    export.append(index, stats)
+                if metrics_out is not None:
+                    write_metrics(metrics_out, index, stats, args.metrics.endswith(".csv"))
+                if aggregate is not None:
+                    aggregate.add(stats)
+                
+                total_moves += stats['total_moves']
+                total_errors += sum(stats['white'][nag] + stats['black'][nag] for nag in [6, 2, 4])
+                if 'budget' in stats:
+                    budget_spent += stats['budget']['spent']
+                checkpoint.record_done({
+                    'games': index,
+                    'next_offset': next_offsets.popleft(),
+                    'pgn_end': pgn_out.tell(),
+                    'evals_end': evals_out.tell(),
+                    'metrics_end': metrics_out.tell() if metrics_out is not None else 0,
+                    'total_moves': total_moves,
+                    'total_errors': total_errors,
+                    'budget_spent': budget_spent,
+                })
         
-        # Write the clean annotated game
-        print(f"Writing annotated game to: {PGN_OUTPUT}")
-        with open(PGN_OUTPUT, "w", encoding="utf-8") as f:
-            print(annotated_game, file=f, end="\n\n")
+        if aggregate is not None:
+            write_aggregate(aggregate, args.aggregate)
+        checkpoint.remove()
         
         print(f"\nAnalysis complete!")
-        print(f"- Annotated PGN saved to: {PGN_OUTPUT}")
-        print(f"- Analysis report saved to: {REPORT_OUTPUT}")
+        print(f"- Annotated PGN saved to: {args.output}")
+        print(f"- Evaluations saved to: {args.output + EVALS_SUFFIX}")
+        if export is not None:
+            print(f"- Ply export saved to: {args.export}/ ({export.rows} plies)")
+        if metrics_out is not None:
+            print(f"- Engine metrics saved to: {args.metrics}")
+        if aggregate is not None:
+            print(f"- Aggregate report saved to: {args.aggregate} ({aggregate_csv_path(args.aggregate)})")
+        if not multi_game:
+            print(f"- Analysis report saved to: {args.report}")
+        else:
+            print(f"- Analysis reports saved to: {report_path(args.report, 1, True)} ... "
+                  f"{report_path(args.report, index, True)}")
         
         # Print quick summary to terminal
-        total_errors = sum(stats['white'][nag] + stats['black'][nag] for nag in [6, 2, 4])
-        print(f"- Total moves analyzed: {stats['total_moves']}")
+        print(f"- Games analyzed: {index}")
+        print(f"- Total moves analyzed: {total_moves}")
         print(f"- Total errors found: {total_errors}")
-        print(f"- White moves: {stats['white']['moves']}")
-        print(f"- Black moves: {stats['black']['moves']}")
-        
+        if budget_kind is not None:
+            budget_given = budget_total * (index if args.budget_scope == 'game' else 1)
+            if budget_kind == 'time':
+                print(f"- Budget spent: {budget_spent:.1f}s of {budget_given:.1f}s of engine time")
+            else:
+                print(f"- Budget spent: {budget_spent:,.0f} of {budget_given:,.0f} nodes")
+    
     except FileNotFoundError as e:
         print(f"Error: File not found - {e}")
     except Exception as e:
         print(f"An error occurred: {e}")
         import traceback
         traceback.print_exc()
+        if os.path.exists(checkpoint.plies_dir):
+            print("Run again with --resume to continue from the last checkpoint.")
+    finally:
+        if export is not None:
+            export.close()
+        if evals_out is not None:
+            evals_out.close()
+        if metrics_out is not None:
+            metrics_out.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Annotator benchmarks
+
+Measure the throughput of annotator.py offline, on generated PGN corpora,
+with fake_uci_engine.py standing in for Stockfish.
+
+USAGE:
+    python3 annotator_bench.py [--suite parse|annotate|stats|order|adaptive|all] [--sizes 1,10,50]
+                               [--delay SECONDS] [--engine COMMAND] [--hash MB]
+"""
+
+import argparse
+import chess
+import chess.engine
+import chess.pgn
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import annotator
+
+# ---------------- CONFIG ----------------
+SEED = 1  # corpora are generated deterministically from this seed
+CORPUS_GAMES = 200
+CORPUS_PLIES = 80
+ANNOTATE_SIZES = [1, 10, 50]  # corpus sizes (games) for the annotate suite
+ENGINE_DELAY = 0.0  # seconds per depth-25 search of the fake engine
+ORDER_GAMES = 48  # corpus size (games) for the order suite
+ORDER_OPENINGS = 16  # distinct openings the games of the order suite start with
+ORDER_OPENING_PLIES = 12
+ORDER_DELAY = 0.02  # the order suite needs searches that cost something
+ADAPTIVE_GAMES = 20  # corpus size (games) for the adaptive suite
+ADAPTIVE_DELAY = 0.01  # without a delay shallow searches cost as much as deep ones
+FAKE_ENGINE = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_uci_engine.py")]
+
+# ---------------- CORPUS ----------------
+
+def generate_game(rng, plies=CORPUS_PLIES, commented=True, opening=()):
+    """Random legal game; optionally with comments, NAGs and side variations.
+    
+    The game starts with the moves of opening (part of the plies).
+    """
+    game = chess.pgn.Game()
+    game.headers["Event"] = f"Benchmark {rng.randrange(10)}"
+    game.headers["White"] = f"Player {rng.randrange(50)}"
+    game.headers["Black"] = f"Player {rng.randrange(50)}"
+    board = game.board()
+    node = game
+    
+    for ply in range(plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        move = opening[ply] if ply < len(opening) else rng.choice(moves)
+        parent = node
+        node = parent.add_variation(move)
+        
+        if commented and len(moves) > 1 and rng.random() < 0.3:
+            # Side line of a few moves, with its own comment
+            sideline = parent.add_variation(rng.choice([m for m in moves if m != move]))
+            sideline.comment = "Another try, with a long explanation of the idea behind it."
+            side_board = sideline.board()
+            for _ in range(rng.randrange(1, 6)):
+                side_moves = list(side_board.legal_moves)
+                if not side_moves:
+                    break
+                sideline = sideline.add_variation(rng.choice(side_moves))
+                side_board.push(sideline.move)
+        
+        board.push(move)
+        if commented:
+            node.comment = f"[%eval {rng.uniform(-3, 3):.2f}] [%clk 0:{rng.randrange(60):02d}:00]"
+            if rng.random() < 0.2:
+                node.nags.add(rng.choice([1, 2, 4, 6]))
+    
+    game.headers["Result"] = board.result()
+    return game
+
+def generate_corpus(games=CORPUS_GAMES, plies=CORPUS_PLIES, commented=True, seed=SEED, openings=0):
+    """PGN text of a corpus of random games.
+    
+    With openings > 0 every game starts with one of that many random opening
+    lines of ORDER_OPENING_PLIES plies, picked at random.
+    """
+    rng = random.Random(seed)
+    lines = [list(generate_game(rng, ORDER_OPENING_PLIES, False).mainline_moves()) for _ in range(openings)]
+    return "".join(str(generate_game(rng, plies, commented, rng.choice(lines) if lines else ())) + "\n\n"
+                   for _ in range(games))
+
+# ---------------- BENCHMARKS ----------------
+
+def bench_parse(pgn_text):
+    """Compare full-tree parsing plus cleaning with the mainline-only visitor."""
+    start = time.perf_counter()
+    full = []
+    handle = io.StringIO(pgn_text)
+    while True:
+        game = chess.pgn.read_game(handle)
+        if game is None:
+            break
+        full.append(str(annotator.clean_game_annotations(game)))
+    full_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    mainline = []
+    handle = io.StringIO(pgn_text)
+    while True:
+        game = annotator.read_mainline_game(handle)
+        if game is None:
+            break
+        mainline.append(str(game))
+    mainline_time = time.perf_counter() - start
+    
+    if full != mainline:
+        raise AssertionError("mainline visitor and clean_game_annotations disagree")
+    
+    return {
+        'games': len(full),
+        'full_time': full_time,
+        'mainline_time': mainline_time,
+        'speedup': full_time / mainline_time if mainline_time > 0 else float('inf'),
+    }
+
+class CountingEngine:
+    """Engine proxy counting the analyse() calls made through it, and those searching to full depth."""
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.calls = 0
+        self.full_depth_calls = 0
+    
+    def analyse(self, board, limit, **kwargs):
+        self.calls += 1
+        if limit.depth is not None and limit.depth >= annotator.DEPTH:
+            self.full_depth_calls += 1
+        return self.engine.analyse(board, limit, **kwargs)
+
+def bench_annotate(pgn_text, engine_command=FAKE_ENGINE):
+    """Run the clean / annotate / report pipeline over a corpus.
+    
+    Returns wall time per stage, engine calls per ply, positions per second
+    and peak Python memory.
+    """
+    timings = {'parse': 0.0, 'annotate': 0.0, 'report': 0.0}
+    plies = 0
+    
+    with chess.engine.SimpleEngine.popen_uci(engine_command) as raw_engine:
+        engine = CountingEngine(raw_engine)
+        tracemalloc.start()
+        handle = io.StringIO(pgn_text)
+        while True:
+            start = time.perf_counter()
+            game = chess.pgn.read_game(handle)
+            if game is None:
+                break
+            game = annotator.clean_game_annotations(game)
+            timings['parse'] += time.perf_counter() - start
+            
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # progress messages
+                annotated_game, stats, annotated_moves = annotator.annotate_game(game, engine)
+            timings['annotate'] += time.perf_counter() - start
+            
+            start = time.perf_counter()
+            annotator.generate_report(annotated_game, stats, annotated_moves)
+            timings['report'] += time.perf_counter() - start
+            plies += stats['total_moves']
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    
+    wall = sum(timings.values())
+    return {
+        'plies': plies,
+        'timings': timings,
+        'wall_time': wall,
+        'engine_calls': engine.calls,
+        'calls_per_ply': engine.calls / plies if plies else 0,
+        'positions_per_second': engine.calls / timings['annotate'] if timings['annotate'] > 0 else 0,
+        'peak_memory': peak,
+    }
+
+def bench_stats(games, plies=CORPUS_PLIES, seed=SEED):
+    """Time the post-engine statistics of a batch of games with random evals.
+    
+    Compares the vectorized eval table passes with the plain Python fallback
+    used when NumPy is not installed.
+    """
+    rng = random.Random(seed)
+    table = annotator.new_eval_table()
+    for game in range(games):
+        analyses = [{'eval': round(rng.gauss(0, 3), 2), 'source': 'engine'} for _ in range(plies + 1)]
+        annotator.append_eval_rows(table, analyses, [ply % 2 for ply in range(plies)],
+                                   [ply // 2 + 1 for ply in range(plies)], game)
+    
+    result = {'plies': len(table['ply'])}
+    numpy = annotator.np
+    for name, module in (('numpy', numpy), ('python', None)):
+        if name == 'numpy' and numpy is None:
+            result['numpy'] = None
+            continue
+        annotator.np = module
+        try:
+            start = time.perf_counter()
+            annotator.aggregate_eval_table(table, annotator.score_eval_table(table))
+            result[name] = time.perf_counter() - start
+        finally:
+            annotator.np = numpy
+    return result
+
+def bench_order(pgn_text, engine_command=FAKE_ENGINE, hash_mb=annotator.ENGINE_HASH):
+    """Annotate a corpus on one engine in input order, then in opening trie order.
+    
+    Each run starts a fresh engine with the given hash size, so only the order
+    of the games differs. Returns the wall time of both runs, the opening
+    plies shared with the previous game and the speedup.
+    """
+    pgn_texts = []
+    handle = io.StringIO(pgn_text)
+    while True:
+        game = annotator.read_mainline_game(handle)
+        if game is None:
+            break
+        pgn_texts.append(str(game))
+    prefixes = [annotator.opening_prefix(text) for text in pgn_texts]
+    
+    result = {'games': len(pgn_texts)}
+    orders = (('input', list(range(len(pgn_texts)))), ('opening', annotator.opening_order(prefixes)))
+    for name, order in orders:
+        with chess.engine.SimpleEngine.popen_uci(engine_command) as engine:
+            engine.configure({"Hash": hash_mb})
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # progress messages
+                for index in order:
+                    annotator.analyse_game_text(engine, pgn_texts[index])
+            result[name] = time.perf_counter() - start
+        result[name + '_shared'] = annotator.shared_plies(prefixes, order)
+    result['speedup'] = result['input'] / result['opening'] if result['opening'] > 0 else float('inf')
+    return result
+
+def bench_adaptive(pgn_text, engine_command=FAKE_ENGINE):
+    """Annotate a corpus at full depth, then in adaptive mode, and compare the NAGs.
+    
+    Adaptive depth is only worth it if every move gets the same annotation
+    as with every position searched to full depth, with fewer full-depth
+    searches. Returns the engine calls (all and full-depth) and time of both
+    runs and the plies whose NAG differs, as (game, ply, full-depth NAG,
+    adaptive NAG).
+    """
+    pgn_texts = []
+    handle = io.StringIO(pgn_text)
+    while True:
+        game = annotator.read_mainline_game(handle)
+        if game is None:
+            break
+        pgn_texts.append(str(game))
+    
+    result = {'games': len(pgn_texts)}
+    nags = {}
+    for name, adaptive in (('full', False), ('adaptive', True)):
+        with chess.engine.SimpleEngine.popen_uci(engine_command) as raw_engine:
+            engine = CountingEngine(raw_engine)
+            start = time.perf_counter()
+            nags[name] = []
+            with contextlib.redirect_stdout(io.StringIO()):  # progress messages
+                for text in pgn_texts:
+                    game = annotator.read_mainline_game(io.StringIO(text))
+                    _, stats, _ = annotator.annotate_game(game, engine, adaptive=adaptive)
+                    nags[name].append([int(nag) for nag in stats['plies']['scores']['nag']])
+            result[name] = time.perf_counter() - start
+            result[name + '_calls'] = engine.calls
+            result[name + '_full_depth'] = engine.full_depth_calls
+    
+    if result['adaptive_full_depth'] >= result['full_full_depth']:
+        raise AssertionError(f"adaptive mode searched {result['adaptive_full_depth']} positions at full depth, "
+                             f"no fewer than the {result['full_full_depth']} of full-depth mode")
+    result['speedup'] = result['full'] / result['adaptive'] if result['adaptive'] > 0 else float('inf')
+    
+    result['plies'] = sum(len(game) for game in nags['full'])
+    result['annotated'] = sum(1 for game in nags['full'] for nag in game if nag)
+    result['mismatches'] = [(game + 1, ply, full, adaptive)
+                            for game, (full_nags, adaptive_nags) in enumerate(zip(nags['full'], nags['adaptive']))
+                            for ply, (full, adaptive) in enumerate(zip(full_nags, adaptive_nags)) if full != adaptive]
+    return result
+
+# ---------------- MAIN ----------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark annotator.py on generated PGN corpora.")
+    parser.add_argument("--pgn", help="benchmark this PGN file instead of a generated corpus")
+    parser.add_argument("--games", type=int, default=CORPUS_GAMES, help=f"games per corpus (default: {CORPUS_GAMES})")
+    parser.add_argument("--plies", type=int, default=CORPUS_PLIES, help=f"plies per game (default: {CORPUS_PLIES})")
+    parser.add_argument("--suite", choices=["parse", "annotate", "stats", "order", "adaptive", "all"], default="all",
+                        help="benchmarks to run")
+    parser.add_argument("--sizes", default=",".join(map(str, ANNOTATE_SIZES)),
+                        help="comma-separated corpus sizes (games) for the annotate suite")
+    parser.add_argument("--delay", type=float, default=ENGINE_DELAY,
+                        help=f"fake engine seconds per depth-25 search (default: {ENGINE_DELAY})")
+    parser.add_argument("--engine", help="UCI engine command instead of the fake engine (e.g. a real Stockfish)")
+    parser.add_argument("--hash", type=int, default=annotator.ENGINE_HASH,
+                        help=f"engine hash size in MB for the order suite (default: {annotator.ENGINE_HASH})")
+    args = parser.parse_args()
+    
+    if args.suite in ("parse", "all"):
+        if args.pgn:
+            with open(args.pgn, 'r', encoding='utf-8') as f:
+                pgn_text = f.read()
+        else:
+            pgn_text = generate_corpus(args.games, args.plies)
+        
+        print("PGN PARSING (full tree + clean vs mainline visitor):")
+        result = bench_parse(pgn_text)
+        print(f"  Games: {result['games']} ({len(pgn_text) / 1e6:.1f} MB)")
+        print(f"  Full tree + clean: {result['full_time']:.2f}s")
+        print(f"  Mainline visitor:  {result['mainline_time']:.2f}s")
+        print(f"  Speedup: {result['speedup']:.1f}x")
+        print("")
+    
+    if args.suite in ("annotate", "all"):
+        engine_command = args.engine.split() if args.engine else FAKE_ENGINE + ["--delay", str(args.delay)]
+        print(f"ANNOTATION PIPELINE (depth {annotator.DEPTH}, engine: {' '.join(engine_command)}):")
+        print(f"  {'Games':>6} {'Plies':>6} {'Calls/ply':>9} {'Parse':>8} {'Annotate':>9} {'Report':>8} "
+              f"{'Pos/s':>8} {'Peak MB':>8}")
+        for size in [int(size) for size in args.sizes.split(",")]:
+            result = bench_annotate(generate_corpus(size, args.plies), engine_command)
+            timings = result['timings']
+            print(f"  {size:>6} {result['plies']:>6} {result['calls_per_ply']:>9.2f} {timings['parse']:>7.2f}s "
+                  f"{timings['annotate']:>8.2f}s {timings['report']:>7.2f}s {result['positions_per_second']:>8.1f} "
+                  f"{result['peak_memory'] / 1e6:>8.1f}")
+        print("")
+    
+    if args.suite in ("stats", "all"):
+        print(f"POST-ENGINE STATISTICS ({args.games} games of {args.plies} plies, random evals):")
+        result = bench_stats(args.games, args.plies)
+        print(f"  Plies: {result['plies']}")
+        if result['numpy'] is not None:
+            print(f"  Vectorized (NumPy): {result['numpy']:.3f}s")
+        else:
+            print("  Vectorized (NumPy): not installed")
+        print(f"  Plain Python:       {result['python']:.3f}s")
+        print("")
+    
+    if args.suite in ("order", "all"):
+        delay = args.delay if args.delay > 0 else ORDER_DELAY
+        engine_command = args.engine.split() if args.engine else FAKE_ENGINE + ["--delay", str(delay)]
+        print(f"GAME ORDER ({ORDER_GAMES} games from {ORDER_OPENINGS} openings, hash {args.hash} MB, "
+              f"engine: {' '.join(engine_command)}):")
+        result = bench_order(generate_corpus(ORDER_GAMES, args.plies, False, openings=ORDER_OPENINGS),
+                             engine_command, args.hash)
+        print(f"  Input order:   {result['input']:.2f}s ({result['input_shared']} opening plies shared)")
+        print(f"  Opening order: {result['opening']:.2f}s ({result['opening_shared']} opening plies shared)")
+        print(f"  Speedup: {result['speedup']:.2f}x")
+        print("")
+    
+    if args.suite in ("adaptive", "all"):
+        delay = args.delay if args.delay > 0 else ADAPTIVE_DELAY
+        engine_command = args.engine.split() if args.engine else FAKE_ENGINE + ["--delay", str(delay)]
+        print(f"ADAPTIVE DEPTH ({ADAPTIVE_GAMES} games, depth {annotator.SHALLOW_DEPTH} then {annotator.DEPTH} "
+              f"within {annotator.ADAPTIVE_MARGIN} pawns of a threshold, engine: {' '.join(engine_command)}):")
+        result = bench_adaptive(generate_corpus(ADAPTIVE_GAMES, args.plies, False), engine_command)
+        print(f"  Full depth: {result['full']:.2f}s ({result['full_calls']} engine calls, "
+              f"{result['full_full_depth']} at depth {annotator.DEPTH})")
+        print(f"  Adaptive:   {result['adaptive']:.2f}s ({result['adaptive_calls']} engine calls, "
+              f"{result['adaptive_full_depth']} at depth {annotator.DEPTH})")
+        print(f"  Speedup: {result['speedup']:.2f}x")
+        print(f"  NAG mismatches: {len(result['mismatches'])} of {result['plies']} plies "
+              f"({result['annotated']} annotated at full depth)")
+        for game, ply, full, adaptive in result['mismatches'][:10]:
+            print(f"    game {game}, ply {ply}: NAG {full} at full depth, {adaptive} adaptive")
+
+if __name__ == "__main__":
+    main()
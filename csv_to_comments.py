@@ -4,11 +4,23 @@ CSV to Student Comments Generator
 
 Convert a CSV file of student names into a formatted comments template.
 Supports multiple output formats: markdown, plain text, and CSV.
+Batch mode converts the rosters of every class in one run; update mode
+merges a changed roster into existing comments files without losing them.
+Written comments can be indexed in a sqlite store and searched across
+classes and years.
 """
 
 import csv
+import glob
+import hashlib
+import io
+import re
+import shutil
+import sqlite3
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 
@@ -19,7 +31,10 @@ CSV to Student Comments Generator
 ==================================
 
 USAGE:
-    python3 csv_to_comments.py INPUT_FILE [FORMAT]
+    python3 csv_to_comments.py INPUT_FILE [FORMAT] [--update]
+    python3 csv_to_comments.py --batch SOURCE [FORMAT] [-o DIR] [-j JOBS] [--update]
+    python3 csv_to_comments.py --ingest PATH... [--db FILE]
+    python3 csv_to_comments.py --search [KEYWORD...] [--student NAME] [--class CLASS] [--db FILE]
 
 ARGUMENTS:
     INPUT_FILE    Path to the CSV file containing student names
@@ -43,6 +58,61 @@ EXAMPLES:
     
     # Generate all formats
     python3 csv_to_comments.py students.csv all
+    
+    # Generate every class roster of a directory into comments/
+    python3 csv_to_comments.py --batch rosters/ all -o comments
+    
+    # A student joined or left: update the files, keeping the comments
+    python3 csv_to_comments.py students.csv all --update
+
+BATCH MODE:
+    SOURCE        A directory (all its .csv files), a quoted glob pattern
+                  such as "classes/*/*.csv", or a manifest: a text file
+                  listing one roster per line (paths relative to the
+                  manifest, lines starting with # are ignored)
+    
+    -o, --output DIR
+                  Directory for the comments files (default: current
+                  directory), created if needed
+    
+    -j, --jobs JOBS
+                  Rosters converted in parallel (default: number of CPUs)
+    
+    Each roster gives comments_<roster name>.<ext>, as in single mode.
+    Files named comments_*.csv are never taken as rosters.
+    Rosters that cannot be read are reported at the end; the others are
+    still generated.
+
+UPDATE MODE:
+    --update      Merge the roster into existing comments files instead of
+                  overwriting them (files that do not exist yet are created):
+                  - new students get a blank section, in surname order
+                  - students no longer in the roster are removed, unless
+                    something was written in their section (then it is
+                    kept and reported)
+                  - everything else stays byte-for-byte identical, and the
+                    file is only rewritten from the first change onwards
+
+COMMENTS STORE:
+    --ingest PATH...
+                  Index comments files (comments_*.md/.txt/.csv, or the
+                  ones found under a directory) in the store. Files whose
+                  size and modification time, or content, are unchanged
+                  since the last ingest are skipped; indexed files that
+                  were deleted from an ingested directory are dropped.
+    
+    --search      Print every student section matching all the filters:
+                  KEYWORD...      words in the comments (accents ignored,
+                                  word* for a prefix)
+                  --student NAME  words of the student's name
+                  --class CLASS   class name (the part after comments_),
+                                  % matches anything, e.g. "T10%"
+    
+    --db FILE     Store file (default: comments.sqlite)
+    
+    # Everything ever written about Marie Dupont
+    python3 csv_to_comments.py --ingest ~/classes --db ~/comments.sqlite
+    python3 csv_to_comments.py --search --student "marie dupont" --db ~/comments.sqlite
 
 INPUT FILE FORMATS:
     
@@ -157,30 +227,50 @@ def extract_students(csv_file):
     return students
 
 
+MARKDOWN_HEADER = "# Student Comments and Observations\n\n---\n\n"
+TEXT_HEADER = "STUDENT COMMENTS\n" + "=" * 60 + "\n\n"
+CSV_HEADER = ['First Name', 'Surname', 'Observations', 'Progress', 'Comments']
+
+
+def markdown_section(name):
+    """Blank markdown section of one student."""
+    return (f"## {name}\n\n"
+            "**Classroom observations:**\n\n\n\n"
+            "**Areas for improvement:**\n\n\n\n"
+            "---\n\n")
+
+
+def text_section(name):
+    """Blank plain text section of one student."""
+    return (f"STUDENT: {name}\n"
+            + "-" * 60 + "\n\n"
+            "Observations:\n\n\n\n"
+            "Comments:\n\n\n\n"
+            + "=" * 60 + "\n\n")
+
+
+def csv_line(fields):
+    """One CSV record, written as create_csv writes it."""
+    line = io.StringIO()
+    csv.writer(line).writerow(fields)
+    return line.getvalue()
+
+
 def create_markdown(students, output_file):
     """Create markdown format comments file."""
     with open(output_file, 'w', encoding='utf-8') as f:
-        f.write("# Student Comments and Observations\n\n")
-        f.write("---\n\n")
+        f.write(MARKDOWN_HEADER)
         for first, last in students:
-            f.write(f"## {first} {last}\n\n")
-            f.write("**Classroom observations:**\n\n\n\n")
-            f.write("**Areas for improvement:**\n\n\n\n")
-            f.write("---\n\n")
+            f.write(markdown_section(f"{first} {last}"))
     print(f"Created: {output_file}")
 
 
 def create_text(students, output_file):
     """Create plain text format comments file."""
     with open(output_file, 'w', encoding='utf-8') as f:
-        f.write("STUDENT COMMENTS\n")
-        f.write("=" * 60 + "\n\n")
+        f.write(TEXT_HEADER)
         for first, last in students:
-            f.write(f"STUDENT: {first} {last}\n")
-            f.write("-" * 60 + "\n\n")
-            f.write("Observations:\n\n\n\n")
-            f.write("Comments:\n\n\n\n")
-            f.write("=" * 60 + "\n\n")
+            f.write(text_section(f"{first} {last}"))
     print(f"Created: {output_file}")
 
 
@@ -188,12 +278,505 @@ def create_csv(students, output_file):
     """Create CSV format comments file."""
     with open(output_file, 'w', encoding='utf-8', newline='') as f:
         writer = csv.writer(f)
-        writer.writerow(['First Name', 'Surname', 'Observations', 'Progress', 'Comments'])
+        writer.writerow(CSV_HEADER)
         for first, last in students:
             writer.writerow([first, last, '', '', ''])
     print(f"Created: {output_file}")
 
 
+def student_key(first, last, extension):
+    """Key of a student's section: the heading name, or (first name, surname) for CSV."""
+    return (first, last) if extension == 'csv' else f"{first} {last}"
+
+
+def blank_section(first, last, extension):
+    if extension == 'md':
+        return markdown_section(f"{first} {last}")
+    if extension == 'txt':
+        return text_section(f"{first} {last}")
+    return csv_line([first, last, '', '', ''])
+
+
+def parse_comments(text, extension):
+    """Split a comments file into its header and its sections, with their text untouched.
+    
+    Returns (header, sections) where each section is (key, text, blank):
+    key as in student_key (None for a CSV row without names), and blank
+    telling whether nothing was written in it yet.
+    """
+    if extension == 'csv':
+        # Collect the raw lines of each record (a comment may span lines)
+        consumed = []
+        
+        def lines():
+            for line in io.StringIO(text, newline=''):
+                consumed.append(line)
+                yield line
+        
+        header = None
+        sections = []
+        for row in csv.reader(lines()):
+            raw = ''.join(consumed)
+            consumed.clear()
+            if header is None:
+                header = raw
+            elif len(row) >= 2 and row[0].strip() and row[1].strip():
+                sections.append(((row[0].strip(), row[1].strip()), raw, not any(f.strip() for f in row[2:])))
+            else:
+                sections.append((None, raw, False))
+        return header or '', sections
+    
+    marker = '## ' if extension == 'md' else 'STUDENT: '
+    parts = re.split(f'(?m)^(?={re.escape(marker)})', text)
+    sections = []
+    for part in parts[1:]:
+        name = part.split('\n', 1)[0][len(marker):].strip()
+        # Blank when only the template's labels and separators are left, whatever the whitespace
+        sections.append((name, part, not section_body(part, extension, None)))
+    return parts[0], sections
+
+
+def update_comments(students, output_file, extension):
+    """Merge the roster into an existing comments file.
+    
+    Sections of students still in the roster are kept as they are, new
+    students get a blank section before the first surname that sorts after
+    theirs, and departed students are removed only while their section is
+    blank. The merged file is written next to the old one and renamed over
+    it, so an interrupted update leaves the comments as they were.
+    """
+    with open(output_file, 'rb') as f:
+        old = f.read()
+    try:
+        text = old.decode('utf-8')
+        header, sections = parse_comments(text, extension)
+    except UnicodeDecodeError as e:
+        print(f"Error reading comments file {output_file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    fresh = {student_key(first, last, extension): (first, last) for first, last in students}
+    present = {key for key, _, _ in sections}
+    merged = []  # (surname, or None when it does not take part in the ordering; section text)
+    removed = 0
+    for key, section, blank in sections:
+        if key in fresh:
+            merged.append((fresh[key][1], section))
+        elif key is not None and blank:
+            removed += 1
+        else:
+            if key is not None:
+                name = key if isinstance(key, str) else ' '.join(key)
+                print(f"Kept: {name} is no longer in the roster but has comments in {output_file}")
+            merged.append((None, section))
+    
+    # New CSV rows use the file's own line endings
+    if extension == 'csv':
+        terminator = '\r\n' if '\r\n' in text or '\n' not in text else '\n'
+    else:
+        terminator = '\n\n'
+    
+    added = 0
+    for first, last in students:
+        if student_key(first, last, extension) in present:
+            continue
+        position = next((i for i, (surname, _) in enumerate(merged) if surname is not None and surname > last),
+                        len(merged))
+        section = blank_section(first, last, extension)
+        if extension == 'csv':
+            section = section.replace('\r\n', terminator)
+        merged.insert(position, (last, section))
+        present.add(student_key(first, last, extension))
+        added += 1
+    
+    # A file saved without its final newline: end the line of whatever now has a section after it,
+    # or the next section would be glued onto it
+    parts = [header] + [section for _, section in merged]
+    for i in range(len(parts) - 1):
+        if parts[i] and not parts[i].endswith(('\n', '\r')):
+            parts[i] += terminator
+    
+    new = ''.join(parts).encode('utf-8')
+    if new == old:
+        print(f"Unchanged: {output_file}")
+        return
+    part_file = f"{output_file}.part"
+    try:
+        with open(part_file, 'wb') as f:
+            f.write(new)
+        shutil.copymode(output_file, part_file)
+        os.replace(part_file, output_file)
+    except OSError as e:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        print(f"Error writing comments file {output_file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Updated: {output_file} ({added} added, {removed} removed)")
+
+
+# Writer and file extension of each output format
+FORMATS = {
+    'md': (create_markdown, 'md'),
+    'txt': (create_text, 'txt'),
+    'csv': (create_csv, 'csv'),
+}
+
+
+def write_comments(students, output_dir, base_name, output_format, update=False):
+    """Write comments_<base_name> in the requested format(s) ('all' for every format).
+    
+    With update, existing files are merged with the roster (see update_comments).
+    """
+    formats = list(FORMATS) if output_format == 'all' else [output_format]
+    for name in formats:
+        writer, extension = FORMATS[name]
+        output_file = output_dir / f"comments_{base_name}.{extension}"
+        if update and output_file.exists():
+            update_comments(students, output_file, extension)
+        else:
+            writer(students, output_file)
+
+
+def find_rosters(source):
+    """Roster files of a directory, glob pattern or manifest file, in a stable order."""
+    path = Path(source)
+    if path.is_dir():
+        matches = path.glob('*.csv')
+    elif any(char in source for char in '*?['):
+        matches = (Path(match) for match in glob.glob(source, recursive=True) if Path(match).is_file())
+    else:
+        matches = None
+    if matches is not None:
+        # Our own CSV outputs are not rosters (the output directory may be the same)
+        return sorted(match for match in matches if not match.name.startswith('comments_'))
+    if not path.is_file():
+        print(f"Error: '{source}' not found.", file=sys.stderr)
+        sys.exit(1)
+    if path.suffix.lower() == '.csv':
+        return [path]
+    
+    # Manifest: one roster per line, relative to the manifest's directory
+    rosters = []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rosters.append(path.parent / line)
+    return rosters
+
+
+def convert_roster(job):
+    """Batch worker: write the comments file(s) of one roster.
+    
+    Returns (roster, number of students, error message or None).
+    """
+    roster, output_dir, output_format, update = job
+    if not roster.exists():
+        return roster, 0, "file not found"
+    try:
+        students = extract_students(roster)
+        if not students:
+            return roster, 0, "no students found"
+        write_comments(students, output_dir, roster.stem, output_format, update)
+    except SystemExit:  # the reason has already been printed
+        return roster, 0, "could not be read"
+    return roster, len(students), None
+
+
+def batch_main(args, update=False):
+    """Generate the comments files of many rosters in one process pool."""
+    output_dir = Path.cwd()
+    jobs = os.cpu_count() or 1
+    positional = []
+    i = 0
+    while i < len(args):
+        if args[i] in ['-o', '--output', '-j', '--jobs']:
+            if i + 1 >= len(args):
+                print(f"Error: {args[i]} needs a value.", file=sys.stderr)
+                sys.exit(1)
+            if args[i] in ['-o', '--output']:
+                output_dir = Path(args[i + 1])
+            elif not args[i + 1].isdigit() or int(args[i + 1]) < 1:
+                print(f"Error: {args[i]} needs a positive number.", file=sys.stderr)
+                sys.exit(1)
+            else:
+                jobs = int(args[i + 1])
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    
+    if not positional or len(positional) > 2:
+        print("Error: --batch needs a SOURCE and optionally a FORMAT (see --help).", file=sys.stderr)
+        sys.exit(1)
+    source = positional[0]
+    output_format = positional[1] if len(positional) > 1 else 'md'
+    if output_format != 'all' and output_format not in FORMATS:
+        print(f"Error: Unknown format '{output_format}'. Use: md, txt, csv, or all", file=sys.stderr)
+        sys.exit(1)
+    
+    rosters = find_rosters(source)
+    if not rosters:
+        print(f"Error: No roster files found in '{source}'.", file=sys.stderr)
+        sys.exit(1)
+    
+    # Two rosters with the same name would overwrite each other's comments
+    stems = {}
+    for roster in rosters:
+        if roster.stem in stems:
+            print(f"Error: '{stems[roster.stem]}' and '{roster}' would both write comments_{roster.stem}.*",
+                  file=sys.stderr)
+            sys.exit(1)
+        stems[roster.stem] = roster
+    
+    output_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Found {len(rosters)} rosters")
+    
+    work = [(roster, output_dir, output_format, update) for roster in rosters]
+    jobs = min(jobs, len(work))
+    if jobs == 1:
+        results = [convert_roster(job) for job in work]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(convert_roster, work))
+    
+    failed = [(roster, error) for roster, _, error in results if error is not None]
+    total = sum(count for _, count, _ in results)
+    print(f"\nDone! {len(results) - len(failed)} of {len(results)} classes ({total} students) "
+          f"created in: {output_dir}")
+    if failed:
+        for roster, error in failed:
+            print(f"Error: {roster}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+
+# ---------------- COMMENTS STORE ----------------
+
+COMMENTS_DB = "comments.sqlite"
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    class TEXT,
+    mtime REAL,
+    size INTEGER,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS sections (
+    id INTEGER PRIMARY KEY,
+    path TEXT,
+    class TEXT,
+    student TEXT,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS sections_path ON sections(path);
+CREATE INDEX IF NOT EXISTS sections_class ON sections(class COLLATE NOCASE);
+CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(
+    student, body, content='sections', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS sections_insert AFTER INSERT ON sections BEGIN
+    INSERT INTO sections_fts(rowid, student, body) VALUES (new.id, new.student, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS sections_delete AFTER DELETE ON sections BEGIN
+    INSERT INTO sections_fts(sections_fts, rowid, student, body) VALUES ('delete', old.id, old.student, old.body);
+END;
+"""
+
+# Lines of the templates that only give structure (see markdown_section and text_section)
+SEPARATOR_LINES = {'---', '-' * 60, '=' * 60}
+LABEL_LINES = {
+    '**Classroom observations:**': 'Classroom observations',
+    '**Areas for improvement:**': 'Areas for improvement',
+    'Observations:': 'Observations',
+    'Comments:': 'Comments',
+}
+
+
+def open_store(db_path):
+    """Open (and create if needed) the comments store."""
+    connection = sqlite3.connect(db_path)
+    connection.executescript(STORE_SCHEMA)
+    return connection
+
+
+def section_body(section, extension, csv_labels):
+    """What the teacher wrote in a section, as "Label: text" lines ('' when blank)."""
+    if extension == 'csv':
+        row = next(csv.reader(io.StringIO(section, newline='')), [])
+        fields = [(label, value.strip()) for label, value in zip(csv_labels[2:], row[2:])]
+    else:
+        fields = []
+        label = None
+        lines = []
+        for line in section.splitlines()[1:]:  # the heading is the student's name
+            if line.strip() in LABEL_LINES:
+                fields.append((label, '\n'.join(lines).strip()))
+                label, lines = LABEL_LINES[line.strip()], []
+            elif line.strip() not in SEPARATOR_LINES:
+                lines.append(line)
+        fields.append((label, '\n'.join(lines).strip()))
+    return '\n'.join(f"{label}: {text}" if label else text for label, text in fields if text)
+
+
+def find_comment_files(paths):
+    """Comments files given directly or found under the given directories."""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(match for extension in FORMATS
+                                for match in path.rglob(f"comments_*.{extension}") if match.is_file()))
+        elif path.is_file():
+            files.append(path)
+        else:
+            print(f"Error: '{path}' not found.", file=sys.stderr)
+            sys.exit(1)
+    return files
+
+
+def ingest_file(connection, path, stat, content):
+    """Replace the indexed sections of one comments file."""
+    extension = path.suffix.lstrip('.')
+    class_name = path.stem[len('comments_'):] if path.stem.startswith('comments_') else path.stem
+    header, sections = parse_comments(content.decode('utf-8'), extension)
+    csv_labels = next(csv.reader(io.StringIO(header, newline='')), []) if extension == 'csv' else []
+    
+    connection.execute("DELETE FROM sections WHERE path = ?", (str(path),))
+    rows = []
+    for key, section, _ in sections:
+        if key is None:
+            continue
+        student = key if isinstance(key, str) else ' '.join(key)
+        rows.append((str(path), class_name, student, section_body(section, extension, csv_labels)))
+    connection.executemany("INSERT INTO sections (path, class, student, body) VALUES (?, ?, ?, ?)", rows)
+    connection.execute("INSERT OR REPLACE INTO files (path, class, mtime, size, sha256) VALUES (?, ?, ?, ?, ?)",
+                       (str(path), class_name, stat.st_mtime, stat.st_size, hashlib.sha256(content).hexdigest()))
+    return len(rows)
+
+
+def ingest(paths, db_path):
+    """Index the comments files of paths, skipping the ones that did not change."""
+    files = [path.resolve() for path in find_comment_files(paths)]
+    directories = [Path(path).resolve() for path in paths if Path(path).is_dir()]
+    ingested = unchanged = sections = removed = 0
+    
+    connection = open_store(db_path)
+    with connection:
+        known = {row[0]: row[1:] for row in connection.execute("SELECT path, mtime, size, sha256 FROM files")}
+        for path in files:
+            if path.suffix.lstrip('.') not in FORMATS:
+                print(f"Skipped: {path} (not a .md, .txt or .csv file)")
+                continue
+            stat = path.stat()
+            previous = known.get(str(path))
+            if previous is not None and previous[:2] == (stat.st_mtime, stat.st_size):
+                unchanged += 1
+                continue
+            content = path.read_bytes()
+            if previous is not None and previous[2] == hashlib.sha256(content).hexdigest():
+                # Touched but not changed: only remember the new modification time
+                connection.execute("UPDATE files SET mtime = ?, size = ? WHERE path = ?",
+                                   (stat.st_mtime, stat.st_size, str(path)))
+                unchanged += 1
+                continue
+            try:
+                sections += ingest_file(connection, path, stat, content)
+            except UnicodeDecodeError as e:
+                print(f"Error reading comments file {path}: {e}", file=sys.stderr)
+                continue
+            ingested += 1
+        
+        # Files deleted from an ingested directory leave the store too
+        for stored in known:
+            stored_path = Path(stored)
+            if not stored_path.exists() and any(directory in stored_path.parents for directory in directories):
+                connection.execute("DELETE FROM sections WHERE path = ?", (stored,))
+                connection.execute("DELETE FROM files WHERE path = ?", (stored,))
+                removed += 1
+    connection.close()
+    
+    print(f"\nDone! {ingested} files ingested ({sections} students), {unchanged} unchanged, "
+          f"{removed} removed, in: {db_path}")
+
+
+def fts_phrase(text):
+    """FTS5 query phrase for user text (a trailing * makes it a prefix)."""
+    prefix = text.endswith('*')
+    return '"' + text.rstrip('*').replace('"', '""') + '"' + ('*' if prefix else '')
+
+
+def search(db_path, keywords=(), student=None, class_name=None):
+    """Print the student sections matching every filter, best matches first."""
+    if not os.path.exists(db_path):
+        print(f"Error: Store '{db_path}' not found (run --ingest first).", file=sys.stderr)
+        sys.exit(1)
+    
+    start = time.perf_counter()
+    terms = [f"body : {fts_phrase(keyword)}" for keyword in keywords]
+    if student:
+        terms.append(f"student : {fts_phrase(student)}")
+    conditions, parameters = [], []
+    if terms:
+        conditions.append("sections_fts MATCH ?")
+        parameters.append(' AND '.join(terms))
+    if class_name:
+        conditions.append("sections.class LIKE ?")
+        parameters.append(class_name)
+    order = "sections_fts.rank" if keywords else "sections.student, sections.class, sections.path"
+    query = (f"SELECT sections.class, sections.student, sections.path, sections.body FROM sections "
+             f"{'JOIN sections_fts ON sections_fts.rowid = sections.id ' if terms else ''}"
+             f"WHERE {' AND '.join(conditions)} ORDER BY {order}")
+    
+    connection = open_store(db_path)
+    try:
+        results = connection.execute(query, parameters).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"Error: Invalid search: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        connection.close()
+    elapsed = (time.perf_counter() - start) * 1000
+    
+    for class_name, student, path, body in results:
+        print(f"{class_name} - {student} ({path})")
+        for line in (body or "(no comments)").splitlines():
+            print(f"    {line}")
+        print()
+    print(f"{len(results)} results in {elapsed:.1f} ms")
+
+
+def store_main(args):
+    """Run --ingest or --search (args start with the command)."""
+    db_path = COMMENTS_DB
+    student = class_name = None
+    positional = []
+    i = 1
+    while i < len(args):
+        if args[i] in ['--db', '--student', '--class']:
+            if i + 1 >= len(args):
+                print(f"Error: {args[i]} needs a value.", file=sys.stderr)
+                sys.exit(1)
+            if args[i] == '--db':
+                db_path = args[i + 1]
+            elif args[i] == '--student':
+                student = args[i + 1]
+            else:
+                class_name = args[i + 1]
+            i += 2
+        else:
+            positional.append(args[i])
+            i += 1
+    
+    if args[0] == '--ingest':
+        if not positional or student or class_name:
+            print("Error: --ingest needs one or more files or directories (see --help).", file=sys.stderr)
+            sys.exit(1)
+        ingest(positional, db_path)
+    else:
+        if not positional and not student and not class_name:
+            print("Error: --search needs keywords, --student or --class (see --help).", file=sys.stderr)
+            sys.exit(1)
+        search(db_path, positional, student, class_name)
+
+
 def main():
     """Main function to process arguments and generate output files."""
     # Check for help flag
@@ -201,8 +784,20 @@ def main():
         show_help()
         sys.exit(0)
     
-    input_file = sys.argv[1]
-    output_format = sys.argv[2] if len(sys.argv) > 2 else 'md'
+    update = '--update' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--update']
+    if args and args[0] == '--batch':
+        batch_main(args[1:], update)
+        return
+    if args and args[0] in ['--ingest', '--search']:
+        store_main(args)
+        return
+    if not args:
+        show_help()
+        sys.exit(0)
+    
+    input_file = args[0]
+    output_format = args[1] if len(args) > 1 else 'md'
     
     if not os.path.exists(input_file):
         print(f"Error: File '{input_file}' not found.", file=sys.stderr)
@@ -222,19 +817,10 @@ def main():
     output_dir = Path.cwd()  # Use current directory instead of input file directory
     
     # Create requested format(s)
-    if output_format == 'all':
-        create_markdown(students, output_dir / f"comments_{base_name}.md")
-        create_text(students, output_dir / f"comments_{base_name}.txt")
-        create_csv(students, output_dir / f"comments_{base_name}.csv")
-    elif output_format == 'md':
-        create_markdown(students, output_dir / f"comments_{base_name}.md")
-    elif output_format == 'txt':
-        create_text(students, output_dir / f"comments_{base_name}.txt")
-    elif output_format == 'csv':
-        create_csv(students, output_dir / f"comments_{base_name}.csv")
-    else:
+    if output_format != 'all' and output_format not in FORMATS:
         print(f"Error: Unknown format '{output_format}'. Use: md, txt, csv, or all", file=sys.stderr)
         sys.exit(1)
+    write_comments(students, output_dir, base_name, output_format, update)
     
     print(f"\nDone! Student comments file(s) created in: {output_dir}")
 
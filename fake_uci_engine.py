@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Fake UCI engine
+
+Deterministic stand-in for Stockfish, for benchmarking annotator.py offline
+and in CI. Scores are derived from a seeded hash of the position, so the same
+position always gets the same evaluation; deeper searches only shift it
+slightly. An optional delay simulates the cost of a real search, and a small
+transposition table makes positions searched recently cheaper to search again.
+
+USAGE:
+    python3 fake_uci_engine.py [--seed N] [--delay SECONDS]
+
+    --delay is the time of a depth-25 search; shallower searches are
+    exponentially cheaper, like the node counts reported.
+"""
+
+import argparse
+import chess
+import chess.polyglot
+import collections
+import math
+import sys
+import time
+
+# ---------------- CONFIG ----------------
+REFERENCE_DEPTH = 25  # --delay is the duration of a search at this depth
+BRANCHING = 1.5  # nodes (and time) grow by this factor per ply of depth
+BASE_NODES = 1000  # nodes of a depth-0 search
+NPS = 1000000  # reported nodes per second when there is no delay
+DEFAULT_DEPTH = 20  # for "go" without a depth, nodes or movetime limit
+TT_POSITIONS_PER_MB = 1  # positions kept per MB of "Hash" (deep searches overwrite most of a real table)
+
+# ---------------- HASH TABLE ----------------
+
+class TranspositionTable:
+    """Depth searched per position, least recently used positions evicted first.
+    
+    A search stores its root and the position after its best move (one ply
+    shallower). Searching a stored position again to depth d only costs the
+    part of the search beyond the stored depth, like iterative deepening on a
+    warm hash table.
+    """
+    
+    def __init__(self, hash_mb=16):
+        self.resize(hash_mb)
+    
+    def resize(self, hash_mb):
+        self.capacity = max(1, hash_mb * TT_POSITIONS_PER_MB)
+        self.clear()
+    
+    def clear(self):
+        self.depths = collections.OrderedDict()
+    
+    def depth(self, board):
+        key = chess.polyglot.zobrist_hash(board)
+        if key not in self.depths:
+            return 0
+        self.depths.move_to_end(key)
+        return self.depths[key]
+    
+    def store(self, board, depth):
+        key = chess.polyglot.zobrist_hash(board)
+        self.depths[key] = max(depth, self.depths.pop(key, 0))
+        while len(self.depths) > self.capacity:
+            self.depths.popitem(last=False)
+
+# ---------------- ENGINE ----------------
+
+def static_score(board, seed, depth):
+    """Deterministic score in centipawns from White's perspective.
+    
+    Most of it depends on the position only; a small part shrinks with depth,
+    so shallow and deep searches disagree a little, like a real engine.
+    """
+    h = chess.polyglot.zobrist_hash(board) ^ (seed * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF)
+    base = h % 601 - 300
+    noise = ((h >> 20) % 41 - 20) * 8 / max(1, depth)
+    return int(base + noise)
+
+def nodes_for_depth(depth):
+    return int(BASE_NODES * BRANCHING ** depth)
+
+def depth_for_nodes(nodes):
+    return max(1, int(math.log(max(nodes, BASE_NODES) / BASE_NODES, BRANCHING)))
+
+def search(board, depth, multipv, seed):
+    """Return the info lines and best move of a fake search."""
+    nodes = nodes_for_depth(depth)
+    stats = f"depth {depth} seldepth {depth + 4} nodes {nodes} nps {NPS} time {nodes * 1000 // NPS}"
+    
+    if board.is_checkmate():
+        return ["info depth 0 score mate 0"], "(none)"
+    if board.is_game_over():
+        return ["info depth 0 score cp 0"], "(none)"
+    
+    sign = 1 if board.turn == chess.WHITE else -1
+    best = sign * static_score(board, seed, depth)
+    lines = []
+    for move in board.legal_moves:
+        board.push(move)
+        # No line is better than the best one (the position's own score)
+        lines.append((min(best, sign * static_score(board, seed, depth)), move.uci()))
+        board.pop()
+    lines.sort(key=lambda line: (-line[0], line[1]))
+    lines[0] = (best, lines[0][1])
+    
+    info = [f"info {stats} multipv {rank} score cp {score} pv {uci}"
+            for rank, (score, uci) in enumerate(lines[:multipv], 1)]
+    return info, lines[0][1]
+
+def parse_position(tokens):
+    """Board for a UCI "position" command (tokens after the command name)."""
+    if tokens[0] == "startpos":
+        board = chess.Board()
+        rest = tokens[1:]
+    else:
+        end = tokens.index("moves") if "moves" in tokens else len(tokens)
+        board = chess.Board(" ".join(tokens[1:end]))
+        rest = tokens[end:]
+    if rest and rest[0] == "moves":
+        for uci in rest[1:]:
+            board.push_uci(uci)
+    return board
+
+def go_depth(tokens, delay):
+    """Depth to report for a UCI "go" command, and how long to take.
+    
+    With several limits the search stops at the first one reached.
+    """
+    depths = []
+    if "depth" in tokens:
+        depths.append(int(tokens[tokens.index("depth") + 1]))
+    if "nodes" in tokens:
+        depths.append(depth_for_nodes(int(tokens[tokens.index("nodes") + 1])))
+    movetime = None
+    if "movetime" in tokens:
+        movetime = int(tokens[tokens.index("movetime") + 1]) / 1000
+        if delay > 0:
+            depths.append(REFERENCE_DEPTH + int(math.log(movetime / delay, BRANCHING)) if movetime > 0 else 1)
+    
+    depth = max(1, min(depths)) if depths else DEFAULT_DEPTH
+    duration = delay * BRANCHING ** (depth - REFERENCE_DEPTH)
+    if movetime is not None:
+        duration = min(duration, movetime)
+    return depth, duration
+
+def warm_duration(duration, depth, stored_depth):
+    """Time of a search whose position is already in the hash table at stored_depth."""
+    return duration * (1 - BRANCHING ** (min(stored_depth, depth) - depth))
+
+def run(seed, delay, stdin=sys.stdin, stdout=sys.stdout):
+    board = chess.Board()
+    multipv = 1
+    table = TranspositionTable()
+    
+    def send(line):
+        stdout.write(line + "\n")
+        stdout.flush()
+    
+    for line in stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            send("id name FakeUCI")
+            send("id author annotator benchmarks")
+            send("option name Threads type spin default 1 min 1 max 1024")
+            send("option name Hash type spin default 16 min 1 max 33554432")
+            send("option name MultiPV type spin default 1 min 1 max 500")
+            send("uciok")
+        elif command == "isready":
+            send("readyok")
+        elif command == "setoption":
+            if "name" in tokens and "value" in tokens:
+                name = " ".join(tokens[tokens.index("name") + 1:tokens.index("value")])
+                if name == "MultiPV":
+                    multipv = int(tokens[tokens.index("value") + 1])
+                elif name == "Hash":
+                    table.resize(int(tokens[tokens.index("value") + 1]))
+        elif command == "ucinewgame":
+            table.clear()
+        elif command == "position":
+            board = parse_position(tokens[1:])
+        elif command == "go":
+            depth, duration = go_depth(tokens[1:], delay)
+            duration = warm_duration(duration, depth, table.depth(board))
+            if duration > 0:
+                time.sleep(duration)
+            info, bestmove = search(board, depth, multipv, seed)
+            table.store(board, depth)
+            if bestmove != "(none)":
+                board.push_uci(bestmove)
+                table.store(board, depth - 1)
+                board.pop()
+            for info_line in info:
+                send(info_line)
+            send(f"bestmove {bestmove}")
+        elif command == "quit":
+            break
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic fake UCI engine for benchmarks.")
+    parser.add_argument("--seed", type=int, default=0, help="score seed (default: 0)")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds per depth-25 search (default: 0)")
+    args = parser.parse_args()
+    run(args.seed, args.delay)
+
+if __name__ == "__main__":
+    main()